@@ -23,7 +23,7 @@ from rag.app.qa import rmPrefix, beAdoc
 from rag.app.tag import label_question
 from rag.nlp import search, rag_tokenizer
 from rag.prompts import keyword_extraction
-from rag.settings import PAGERANK_FLD
+from rag.settings import PAGERANK_FLD, TERM_WEIGHT_FLD
 from rag.utils import rmSpace
 from api.db import LLMType, ParserType
 from api.db.services.knowledgebase_service import KnowledgebaseService
@@ -139,6 +139,8 @@ def set():
         d["tag_feas"] = req["tag_feas"]
     if "available_int" in req:
         d["available_int"] = req["available_int"]
+    # the stored term weights are stale now, reranking falls back to the chunk's tokens
+    d[TERM_WEIGHT_FLD] = ""
 
     try:
         tenant_id = DocumentService.get_tenant_id(req["doc_id"])
@@ -233,6 +235,7 @@ def create():
         d["docnm_kwd"] = doc.name
         d["title_tks"] = rag_tokenizer.tokenize(doc.name)
         d["doc_id"] = doc.id
+        d[TERM_WEIGHT_FLD] = settings.retrievaler.term_weight_field(d)
 
         tenant_id = DocumentService.get_tenant_id(req["doc_id"])
         if not tenant_id:
@@ -362,6 +362,8 @@ def run():
                 info["chunk_num"] = 0
                 info["token_num"] = 0
             DocumentService.update_by_id(id, info)
+            if str(req["run"]) == TaskStatus.CANCEL.value:
+                TaskService.set_cancel_flag(id)
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
                 return get_data_error_result(message="Tenant not found!")
@@ -126,6 +126,7 @@ def set_api_key():
                 max_tokens=llm_config["max_tokens"]
             )
 
+    TenantLLMService.invalidate_model_cache(current_user.id)
     return get_json_result(data=True)
 
 
@@ -289,6 +290,7 @@ def add_llm():
              TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
 
+    TenantLLMService.invalidate_model_cache(current_user.id)
     return get_json_result(data=True)
 
 
@@ -300,6 +302,7 @@ def delete_llm():
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"],
          TenantLLM.llm_name == req["llm_name"]])
+    TenantLLMService.invalidate_model_cache(current_user.id)
     return get_json_result(data=True)
 
 
@@ -310,6 +313,7 @@ def delete_factory():
     req = request.json
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"]])
+    TenantLLMService.invalidate_model_cache(current_user.id)
     return get_json_result(data=True)
 
 
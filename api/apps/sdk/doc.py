@@ -41,6 +41,7 @@ from rag.nlp import search
 from rag.prompts import keyword_extraction
 from rag.app.tag import label_question
 from rag.utils import rmSpace
+from rag.settings import TERM_WEIGHT_FLD
 from rag.utils.storage_factory import STORAGE_IMPL
 
 from pydantic import BaseModel, Field, validator
@@ -736,6 +737,7 @@ def stop_parsing(tenant_id, dataset_id):
             )
         info = {"run": "2", "progress": 0, "chunk_num": 0}
         DocumentService.update_by_id(id, info)
+        TaskService.set_cancel_flag(id)
         settings.docStoreConn.delete({"doc_id": doc[0].id}, search.index_name(tenant_id), dataset_id)
     return get_result()
 
@@ -1016,6 +1018,7 @@ def add_chunk(tenant_id, dataset_id, document_id):
     d["kb_id"] = dataset_id
     d["docnm_kwd"] = doc.name
     d["doc_id"] = document_id
+    d[TERM_WEIGHT_FLD] = settings.retrievaler.term_weight_field(d)
     embd_id = DocumentService.get_embd_id(document_id)
     embd_mdl = TenantLLMService.model_instance(
         tenant_id, LLMType.EMBEDDING.value, embd_id
@@ -1196,6 +1199,8 @@ def update_chunk(tenant_id, dataset_id, document_id, chunk_id):
         d["question_tks"] = rag_tokenizer.tokenize("\n".join(req["questions"]))
     if "available" in req:
         d["available_int"] = int(req["available"])
+    # the stored term weights are stale now, reranking falls back to the chunk's tokens
+    d[TERM_WEIGHT_FLD] = ""
     embd_id = DocumentService.get_embd_id(document_id)
     embd_mdl = TenantLLMService.model_instance(
         tenant_id, LLMType.EMBEDDING.value, embd_id
@@ -282,9 +282,9 @@ def chat_completion_openai_like(tenant_id, chat_id):
             }
 
             try:
-                for ans in chat(dia, msg, True):
-                    answer = ans["answer"]
-                    incremental = answer[token_used:]
+                for ans in chat(dia, msg, True, delta=True):
+                    # delta events carry the new text only, the others the whole answer so far
+                    incremental = ans["answer"] if ans.get("delta") else ans["answer"][token_used:]
                     token_used += len(incremental)
                     response["choices"][0]["delta"]["content"] = incremental
                     yield f"data:{json.dumps(response, ensure_ascii=False)}\n\n"
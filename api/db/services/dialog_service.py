@@ -15,6 +15,7 @@
 #
 import logging
 import binascii
+import os
 import time
 from functools import partial
 import re
@@ -31,9 +32,12 @@ from rag.app.resume import forbidden_select_fields4resume
 from rag.app.tag import label_question
 from rag.nlp.search import index_name
 from rag.prompts import kb_prompt, message_fit_in, llm_id2llm_type, keyword_extraction, full_question, chunks_format
-from rag.utils import rmSpace, num_tokens_from_string
+from rag.utils import rmSpace
 from rag.utils.tavily_conn import Tavily
 
+# Streamed answers are sent once at least this many new characters are generated.
+CHAT_STREAM_MIN_DELTA_CHARS = int(os.environ.get("CHAT_STREAM_MIN_DELTA_CHARS", "32"))
+
 
 class DialogService(CommonService):
     model = Dialog
@@ -61,7 +65,16 @@ class DialogService(CommonService):
         return list(chats.dicts())
 
 
-def chat_solo(dialog, messages, stream=True):
+def stream_event(answer, delta_ans, delta, tts_mdl):
+    """
+    With `delta`, the event carries only the text generated since the previous event instead of the answer so far.
+    """
+    if delta:
+        return {"answer": delta_ans, "delta": True, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
+    return {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
+
+
+def chat_solo(dialog, messages, stream=True, delta=False):
     if llm_id2llm_type(dialog.llm_id) == "image2text":
         chat_mdl = LLMBundle(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
     else:
@@ -75,13 +88,20 @@ def chat_solo(dialog, messages, stream=True):
                 for m in messages if m["role"] != "system"]
     if stream:
         last_ans = ""
+        answer = ""
         for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
             answer = ans
             delta_ans = ans[len(last_ans):]
-            if num_tokens_from_string(delta_ans) < 16:
+            if len(delta_ans) < CHAT_STREAM_MIN_DELTA_CHARS:
                 continue
             last_ans = answer
-            yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans), "prompt":"", "created_at": time.time()}
+            yield {**stream_event(answer, delta_ans, delta, tts_mdl), "prompt": "", "created_at": time.time()}
+        delta_ans = answer[len(last_ans):]
+        if delta_ans:
+            yield {**stream_event(answer, delta_ans, delta, tts_mdl), "prompt": "", "created_at": time.time()}
+        if delta:
+            # the whole answer, for the callers keeping the conversation
+            yield {"answer": answer, "reference": {}, "audio_binary": None, "prompt": "", "created_at": time.time()}
     else:
         answer = chat_mdl.chat(prompt_config.get("system", ""), msg, dialog.llm_setting)
         user_content = msg[-1].get("content", "[content not available]")
@@ -90,18 +110,24 @@ def chat_solo(dialog, messages, stream=True):
 
 
 def chat(dialog, messages, stream=True, **kwargs):
+    """
+    With `delta=True` in kwargs, streamed events carry "delta": True and only the newly generated text, to be appended
+    to the answer so far. Events without it carry the whole answer so far, e.g. the reasoning progress, and the last
+    one the whole answer and its reference as without the flag.
+    """
     assert messages[-1]["role"] == "user", "The last content of this conversation is not from user."
+    delta = bool(kwargs.get("delta", False))
     if not dialog.kb_ids:
-        for ans in chat_solo(dialog, messages, stream):
+        for ans in chat_solo(dialog, messages, stream, delta):
             yield ans
         return
 
     chat_start_ts = timer()
 
     if llm_id2llm_type(dialog.llm_id) == "image2text":
-        llm_model_config = TenantLLMService.get_model_config(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
+        llm_model_config = TenantLLMService.get_cached_model_config(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
     else:
-        llm_model_config = TenantLLMService.get_model_config(dialog.tenant_id, LLMType.CHAT, dialog.llm_id)
+        llm_model_config = TenantLLMService.get_cached_model_config(dialog.tenant_id, LLMType.CHAT, dialog.llm_id)
 
     max_tokens = llm_model_config.get("max_tokens", 8192)
 
@@ -296,18 +322,21 @@ def chat(dialog, messages, stream=True, **kwargs):
     if stream:
         last_ans = ""
         answer = ""
+        if delta and thought:
+            # replaces the reasoning progress, the deltas of the answer are appended to it
+            yield {"answer": thought, "reference": {}, "audio_binary": None}
         for ans in chat_mdl.chat_streamly(prompt, msg[1:], gen_conf):
             if thought:
                 ans = re.sub(r"<think>.*</think>", "", ans, flags=re.DOTALL)
             answer = ans
             delta_ans = ans[len(last_ans):]
-            if num_tokens_from_string(delta_ans) < 16:
+            if len(delta_ans) < CHAT_STREAM_MIN_DELTA_CHARS:
                 continue
+            yield stream_event(thought+answer, delta_ans, delta, tts_mdl)
             last_ans = answer
-            yield {"answer": thought+answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
         delta_ans = answer[len(last_ans):]
         if delta_ans:
-            yield {"answer": thought+answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
+            yield stream_event(thought+answer, delta_ans, delta, tts_mdl)
         yield decorate_answer(thought+answer)
     else:
         answer = chat_mdl.chat(prompt, msg[1:], gen_conf)
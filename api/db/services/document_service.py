@@ -42,6 +42,9 @@ from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db import StatusEnum
 from rag.utils.redis_conn import REDIS_CONN
 
+# Redis set of the documents whose tasks reported progress since the last aggregation.
+DOC_PROGRESS_EVENTS = "doc_progress_events"
+
 
 class DocumentService(CommonService):
     model = Document
@@ -152,7 +155,7 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
+    def get_unfinished_docs(cls, doc_ids=None):
         fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg,
                   cls.model.run, cls.model.parser_id]
         docs = cls.model.select(*fields) \
@@ -161,6 +164,8 @@ class DocumentService(CommonService):
             ~(cls.model.type == FileType.VIRTUAL.value),
             cls.model.progress < 1,
             cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(doc_ids))
         return list(docs.dicts())
 
     @classmethod
@@ -378,74 +383,108 @@ class DocumentService(CommonService):
     def update_meta_fields(cls, doc_id, meta_fields):
         return cls.update_by_id(doc_id, {"meta_fields": meta_fields})
 
+    @staticmethod
+    def publish_progress_event(doc_id):
+        """
+        Called by the task executors whenever the progress of a task of the document is written.
+        """
+        REDIS_CONN.sadd(DOC_PROGRESS_EVENTS, doc_id)
+
     @classmethod
     @DB.connection_context()
-    def update_progress(cls):
+    def update_progress(cls, full=False):
+        """
+        Rolls the progress of tasks up to their documents. Only the documents with progress events since the last
+        call are looked at, all the unfinished ones with `full`, which also catches events lost on the way.
+        Documents and their tasks are read with one query each per 1024 documents.
+        """
+        if full:
+            docs = cls.get_unfinished_docs()
+        else:
+            doc_ids = []
+            while True:
+                ids = REDIS_CONN.spop(DOC_PROGRESS_EVENTS, 1024)
+                doc_ids.extend(ids)
+                if len(ids) < 1024:
+                    break
+            if not doc_ids:
+                return
+            docs = []
+            for i in range(0, len(doc_ids), 1024):
+                docs.extend(cls.get_unfinished_docs(doc_ids[i:i + 1024]))
+
+        for i in range(0, len(docs), 1024):
+            batch = docs[i:i + 1024]
+            tasks = {}
+            for t in Task.select(Task.doc_id, Task.progress, Task.progress_msg).where(
+                    Task.doc_id.in_([d["id"] for d in batch])).order_by(Task.create_time):
+                tasks.setdefault(t.doc_id, []).append(t)
+            for d in batch:
+                cls._update_doc_progress(d, tasks.get(d["id"], []))
+
+    @classmethod
+    def _update_doc_progress(cls, d, tsks):
         MSG = {
             "raptor": "Start RAPTOR (Recursive Abstractive Processing for Tree-Organized Retrieval).",
             "graphrag": "Entities",
             "graph_resolution": "Resolution",
             "graph_community": "Communities"
         }
-        docs = cls.get_unfinished_docs()
-        for d in docs:
-            try:
-                tsks = Task.query(doc_id=d["id"], order_by=Task.create_time)
-                if not tsks:
-                    continue
-                msg = []
-                prg = 0
-                finished = True
-                bad = 0
-                e, doc = DocumentService.get_by_id(d["id"])
-                status = doc.run  # TaskStatus.RUNNING.value
-                for t in tsks:
-                    if 0 <= t.progress < 1:
-                        finished = False
-                    prg += t.progress if t.progress >= 0 else 0
-                    if t.progress_msg not in msg:
-                        msg.append(t.progress_msg)
-                    if t.progress == -1:
-                        bad += 1
-                prg /= len(tsks)
-                if finished and bad:
-                    prg = -1
-                    status = TaskStatus.FAIL.value
-                elif finished:
-                    m = "\n".join(sorted(msg))
-                    if d["parser_config"].get("raptor", {}).get("use_raptor") and m.find(MSG["raptor"]) < 0:
-                        queue_raptor_o_graphrag_tasks(d, "raptor", MSG["raptor"])
-                        prg = 0.98 * len(tsks) / (len(tsks) + 1)
-                    elif d["parser_config"].get("graphrag", {}).get("use_graphrag") and m.find(MSG["graphrag"]) < 0:
-                        queue_raptor_o_graphrag_tasks(d, "graphrag", MSG["graphrag"])
-                        prg = 0.98 * len(tsks) / (len(tsks) + 1)
-                    elif d["parser_config"].get("graphrag", {}).get("use_graphrag") \
-                        and d["parser_config"].get("graphrag", {}).get("resolution") \
-                        and m.find(MSG["graph_resolution"]) < 0:
-                        queue_raptor_o_graphrag_tasks(d, "graph_resolution", MSG["graph_resolution"])
-                        prg = 0.98 * len(tsks) / (len(tsks) + 1)
-                    elif d["parser_config"].get("graphrag", {}).get("use_graphrag") \
-                        and d["parser_config"].get("graphrag", {}).get("community") \
-                        and m.find(MSG["graph_community"]) < 0:
-                        queue_raptor_o_graphrag_tasks(d, "graph_community", MSG["graph_community"])
-                        prg = 0.98 * len(tsks) / (len(tsks) + 1)
-                    else:
-                        status = TaskStatus.DONE.value
-
-                msg = "\n".join(sorted(msg))
-                info = {
-                    "process_duation": datetime.timestamp(
-                        datetime.now()) -
-                                       d["process_begin_at"].timestamp(),
-                    "run": status}
-                if prg != 0:
-                    info["progress"] = prg
-                if msg:
-                    info["progress_msg"] = msg
-                cls.update_by_id(d["id"], info)
-            except Exception as e:
-                if str(e).find("'0'") < 0:
-                    logging.exception("fetch task exception")
+        try:
+            if not tsks:
+                return
+            msg = []
+            prg = 0
+            finished = True
+            bad = 0
+            status = d["run"]  # TaskStatus.RUNNING.value
+            for t in tsks:
+                if 0 <= t.progress < 1:
+                    finished = False
+                prg += t.progress if t.progress >= 0 else 0
+                if t.progress_msg not in msg:
+                    msg.append(t.progress_msg)
+                if t.progress == -1:
+                    bad += 1
+            prg /= len(tsks)
+            if finished and bad:
+                prg = -1
+                status = TaskStatus.FAIL.value
+            elif finished:
+                m = "\n".join(sorted(msg))
+                if d["parser_config"].get("raptor", {}).get("use_raptor") and m.find(MSG["raptor"]) < 0:
+                    queue_raptor_o_graphrag_tasks(d, "raptor", MSG["raptor"])
+                    prg = 0.98 * len(tsks) / (len(tsks) + 1)
+                elif d["parser_config"].get("graphrag", {}).get("use_graphrag") and m.find(MSG["graphrag"]) < 0:
+                    queue_raptor_o_graphrag_tasks(d, "graphrag", MSG["graphrag"])
+                    prg = 0.98 * len(tsks) / (len(tsks) + 1)
+                elif d["parser_config"].get("graphrag", {}).get("use_graphrag") \
+                    and d["parser_config"].get("graphrag", {}).get("resolution") \
+                    and m.find(MSG["graph_resolution"]) < 0:
+                    queue_raptor_o_graphrag_tasks(d, "graph_resolution", MSG["graph_resolution"])
+                    prg = 0.98 * len(tsks) / (len(tsks) + 1)
+                elif d["parser_config"].get("graphrag", {}).get("use_graphrag") \
+                    and d["parser_config"].get("graphrag", {}).get("community") \
+                    and m.find(MSG["graph_community"]) < 0:
+                    queue_raptor_o_graphrag_tasks(d, "graph_community", MSG["graph_community"])
+                    prg = 0.98 * len(tsks) / (len(tsks) + 1)
+                else:
+                    status = TaskStatus.DONE.value
+
+            msg = "\n".join(sorted(msg))
+            info = {
+                "process_duation": datetime.timestamp(
+                    datetime.now()) -
+                                   d["process_begin_at"].timestamp(),
+                "run": status}
+            if prg != 0:
+                info["progress"] = prg
+            if msg:
+                info["progress_msg"] = msg
+            cls.update_by_id(d["id"], info)
+        except Exception as e:
+            if str(e).find("'0'") < 0:
+                logging.exception("fetch task exception")
 
     @classmethod
     @DB.connection_context()
@@ -13,17 +13,65 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import atexit
 import json
 import logging
 import os
+import threading
+import time
+import uuid
+
+import numpy as np
 
 from api.db.services.user_service import TenantService
 from api.utils.file_utils import get_project_base_directory
 from rag.llm import EmbeddingModel, CvModel, ChatModel, RerankModel, Seq2txtModel, TTSModel
+from rag.llm.embedding_batcher import get_embedding_batcher
+from rag.llm.embedding_cache import embedding_cache_enabled, embedding_model_key, get_embeddings, set_embeddings
 from api.db import LLMType
 from api.db.db_models import DB
 from api.db.db_models import LLMFactories, LLM, TenantLLM
 from api.db.services.common_service import CommonService
+from rag.utils.redis_conn import REDIS_CONN
+
+# Seconds model configs and model clients of a tenant are reused, 0 disables the cache.
+LLM_INSTANCE_CACHE_TTL = int(os.environ.get("LLM_INSTANCE_CACHE_TTL", "300"))
+
+# Seconds token usage is summed up in memory before being written, 0 writes it after every model call.
+LLM_USAGE_FLUSH_INTERVAL = int(os.environ.get("LLM_USAGE_FLUSH_INTERVAL", "5"))
+
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+
+_pending_usage = {}
+_pending_usage_lock = threading.Lock()
+_usage_flusher = None
+
+
+def _tenant_llm_version_key(tenant_id):
+    return "tenant_llm_version:{}".format(tenant_id)
+
+
+def _cached(tenant_id, key, build):
+    """
+    Entries are dropped after LLM_INSTANCE_CACHE_TTL, or once the tenant's LLM settings change in any process,
+    which is told by the tenant's version in Redis.
+    """
+    if LLM_INSTANCE_CACHE_TTL <= 0:
+        return build()
+    version = REDIS_CONN.get(_tenant_llm_version_key(tenant_id))
+    now = time.time()
+    with _model_cache_lock:
+        ent = _model_cache.get(key)
+    if ent and ent[0] > now and ent[1] == version:
+        return ent[2]
+    v = build()
+    with _model_cache_lock:
+        if len(_model_cache) > 4096:
+            for k in [k for k, e in _model_cache.items() if e[0] <= now]:
+                del _model_cache[k]
+        _model_cache[key] = (now + LLM_INSTANCE_CACHE_TTL, version, v)
+    return v
 
 
 class LLMFactoriesService(CommonService):
@@ -125,11 +173,34 @@ class TenantLLMService(CommonService):
                     raise LookupError("Model({}) not authorized".format(mdlnm))
         return model_config
 
+    @classmethod
+    def get_cached_model_config(cls, tenant_id, llm_type, llm_name=None):
+        return _cached(tenant_id, ("config", tenant_id, str(llm_type), llm_name),
+                       lambda: cls.get_model_config(tenant_id, llm_type, llm_name))
+
+    @classmethod
+    def invalidate_model_cache(cls, tenant_id):
+        """
+        To be called when the LLM settings of the tenant change.
+        """
+        with _model_cache_lock:
+            for k in [k for k in _model_cache.keys() if k[1] == tenant_id]:
+                del _model_cache[k]
+        REDIS_CONN.set(_tenant_llm_version_key(tenant_id), uuid.uuid1().hex, max(LLM_INSTANCE_CACHE_TTL, 1) * 2)
+
     @classmethod
     @DB.connection_context()
     def model_instance(cls, tenant_id, llm_type,
                        llm_name=None, lang="Chinese"):
-        model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+        """
+        Model clients are reused across requests of the tenant, together with their HTTP connection pools.
+        """
+        model_config = cls.get_cached_model_config(tenant_id, llm_type, llm_name)
+        return _cached(tenant_id, ("instance", tenant_id, str(llm_type), llm_name, lang),
+                       lambda: cls._build_model_instance(model_config, llm_type, lang))
+
+    @staticmethod
+    def _build_model_instance(model_config, llm_type, lang):
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
                 return
@@ -213,6 +284,45 @@ class TenantLLMService(CommonService):
 
         return num
 
+    @classmethod
+    def add_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
+        """
+        Buffers the usage, a background thread writes the sums per tenant and model every LLM_USAGE_FLUSH_INTERVAL
+        seconds, and once more at exit.
+        """
+        global _usage_flusher
+        if LLM_USAGE_FLUSH_INTERVAL <= 0:
+            return cls.increase_usage(tenant_id, llm_type, used_tokens, llm_name)
+        if not used_tokens:
+            return True
+        key = (tenant_id, str(llm_type), llm_name)
+        with _pending_usage_lock:
+            _pending_usage[key] = _pending_usage.get(key, 0) + used_tokens
+            if _usage_flusher is None:
+                _usage_flusher = threading.Thread(target=cls._flush_usage_periodically, daemon=True)
+                _usage_flusher.start()
+                atexit.register(cls.flush_usage)
+        return True
+
+    @classmethod
+    def flush_usage(cls):
+        global _pending_usage
+        with _pending_usage_lock:
+            usage, _pending_usage = _pending_usage, {}
+        for (tenant_id, llm_type, llm_name), used_tokens in usage.items():
+            if not cls.increase_usage(tenant_id, llm_type, used_tokens, llm_name):
+                logging.error("TenantLLMService.flush_usage can't update token usage for {}/{} llm_name: {}, used_tokens: {}".format(
+                    tenant_id, llm_type, llm_name, used_tokens))
+
+    @classmethod
+    def _flush_usage_periodically(cls):
+        while True:
+            time.sleep(LLM_USAGE_FLUSH_INTERVAL)
+            try:
+                cls.flush_usage()
+            except Exception:
+                logging.exception("TenantLLMService.flush_usage got exception")
+
     @classmethod
     @DB.connection_context()
     def get_openai_models(cls):
@@ -233,12 +343,36 @@ class LLMBundle(object):
             tenant_id, llm_type, llm_name, lang=lang)
         assert self.mdl, "Can't find model for {}/{}/{}".format(
             tenant_id, llm_type, llm_name)
-        model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+        model_config = TenantLLMService.get_cached_model_config(tenant_id, llm_type, llm_name)
         self.max_length = model_config.get("max_tokens", 8192)
+        self.max_batch_size = getattr(self.mdl, "max_batch_size", 16)
+        self.max_batch_tokens = getattr(self.mdl, "max_batch_tokens", 0)
+        self.batcher = get_embedding_batcher(model_config, self.mdl) if llm_type == LLMType.EMBEDDING.value else None
+        self.embedding_cache_key = embedding_model_key(model_config) \
+            if llm_type == LLMType.EMBEDDING.value and embedding_cache_enabled() else None
+
+    def _encode(self, texts: list):
+        if self.batcher:
+            return self.batcher.encode(self.tenant_id, texts)
+        return self.mdl.encode(texts)
 
     def encode(self, texts: list):
-        embeddings, used_tokens = self.mdl.encode(texts)
-        if not TenantLLMService.increase_usage(
+        if not texts or not self.embedding_cache_key:
+            embeddings, used_tokens = self._encode(texts)
+        else:
+            # only the texts missing from the embedding cache are sent to the model
+            embeddings = get_embeddings(self.embedding_cache_key, texts)
+            missing = [i for i, v in enumerate(embeddings) if v is None]
+            used_tokens = 0
+            if missing:
+                vts, used_tokens = self._encode([texts[i] for i in missing])
+                for i, v in zip(missing, vts):
+                    embeddings[i] = v
+                set_embeddings(self.embedding_cache_key, [texts[i] for i in missing], vts)
+            embeddings = np.array(embeddings)
+            if not missing:
+                return embeddings, used_tokens
+        if not TenantLLMService.add_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             logging.error(
                 "LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -246,7 +380,7 @@ class LLMBundle(object):
 
     def encode_queries(self, query: str):
         emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(
+        if not TenantLLMService.add_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             logging.error(
                 "LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -254,7 +388,7 @@ class LLMBundle(object):
 
     def similarity(self, query: str, texts: list):
         sim, used_tokens = self.mdl.similarity(query, texts)
-        if not TenantLLMService.increase_usage(
+        if not TenantLLMService.add_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             logging.error(
                 "LLMBundle.similarity can't update token usage for {}/RERANK used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -262,7 +396,7 @@ class LLMBundle(object):
 
     def describe(self, image, max_tokens=300):
         txt, used_tokens = self.mdl.describe(image, max_tokens)
-        if not TenantLLMService.increase_usage(
+        if not TenantLLMService.add_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             logging.error(
                 "LLMBundle.describe can't update token usage for {}/IMAGE2TEXT used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -270,7 +404,7 @@ class LLMBundle(object):
 
     def transcription(self, audio):
         txt, used_tokens = self.mdl.transcription(audio)
-        if not TenantLLMService.increase_usage(
+        if not TenantLLMService.add_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             logging.error(
                 "LLMBundle.transcription can't update token usage for {}/SEQUENCE2TXT used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -279,7 +413,7 @@ class LLMBundle(object):
     def tts(self, text):
         for chunk in self.mdl.tts(text):
             if isinstance(chunk, int):
-                if not TenantLLMService.increase_usage(
+                if not TenantLLMService.add_usage(
                         self.tenant_id, self.llm_type, chunk, self.llm_name):
                     logging.error(
                         "LLMBundle.tts can't update token usage for {}/TTS".format(self.tenant_id))
@@ -288,7 +422,7 @@ class LLMBundle(object):
 
     def chat(self, system, history, gen_conf):
         txt, used_tokens = self.mdl.chat(system, history, gen_conf)
-        if isinstance(txt, int) and not TenantLLMService.increase_usage(
+        if isinstance(txt, int) and not TenantLLMService.add_usage(
                 self.tenant_id, self.llm_type, used_tokens, self.llm_name):
             logging.error(
                 "LLMBundle.chat can't update token usage for {}/CHAT llm_name: {}, used_tokens: {}".format(self.tenant_id, self.llm_name,
@@ -298,7 +432,7 @@ class LLMBundle(object):
     def chat_streamly(self, system, history, gen_conf):
         for txt in self.mdl.chat_streamly(system, history, gen_conf):
             if isinstance(txt, int):
-                if not TenantLLMService.increase_usage(
+                if not TenantLLMService.add_usage(
                         self.tenant_id, self.llm_type, txt, self.llm_name):
                     logging.error(
                         "LLMBundle.chat_streamly can't update token usage for {}/CHAT llm_name: {}, content: {}".format(self.tenant_id, self.llm_name,
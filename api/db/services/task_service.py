@@ -176,6 +176,21 @@ class TaskService(CommonService):
         _, doc = DocumentService.get_by_id(task.doc_id)
         return doc.run == TaskStatus.CANCEL.value or doc.progress < 0
 
+    @staticmethod
+    def cancel_flag_key(doc_id):
+        return f"{doc_id}-cancel"
+
+    @classmethod
+    def set_cancel_flag(cls, doc_id):
+        """
+        Lets the executors running tasks of the document notice the cancellation without querying the database.
+        """
+        REDIS_CONN.set(cls.cancel_flag_key(doc_id), "x", 24 * 3600)
+
+    @classmethod
+    def has_cancel_flag(cls, doc_id):
+        return bool(REDIS_CONN.exist(cls.cancel_flag_key(doc_id)))
+
     @classmethod
     @DB.connection_context()
     def update_progress(cls, id, info):
@@ -200,12 +215,29 @@ class TaskService(CommonService):
                     cls.model.id == id
                 ).execute()
 
+    @classmethod
+    @DB.connection_context()
+    def append_progress(cls, id, progress_msg, progress=None):
+        """
+        Appends the messages and sets the progress in one update. Unlike update_progress it takes no global lock:
+        the row of a task is only written by the executor running it, which serializes its own writes.
+        """
+        d = {}
+        if progress_msg:
+            task = cls.model.get_by_id(id)
+            d["progress_msg"] = trim_header_by_lines(task.progress_msg + "\n" + progress_msg, 3000)
+        if progress is not None:
+            d["progress"] = progress
+        if d:
+            cls.model.update(**d).where(cls.model.id == id).execute()
+
 
 def queue_tasks(doc: dict, bucket: str, name: str):
     def new_task():
         return {"id": get_uuid(), "doc_id": doc["id"], "progress": 0.0, "from_page": 0, "to_page": 100000000}
 
     parse_task_array = []
+    REDIS_CONN.delete(TaskService.cancel_flag_key(doc["id"]))
 
     if doc["type"] == FileType.PDF.value:
         file_bin = STORAGE_IMPL.get(bucket, name)
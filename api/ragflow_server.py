@@ -18,7 +18,7 @@
 # from beartype.claw import beartype_all  # <-- you didn't sign up for this
 # beartype_all(conf=BeartypeConf(violation_type=UserWarning))    # <-- emit warnings from all code
 
-from api.utils.log_utils import initRootLogger
+from api.utils.log_utils import initRootLogger, log_startup_time
 initRootLogger("ragflow_server")
 
 import logging
@@ -45,11 +45,18 @@ from rag.settings import print_rag_settings
 
 stop_event = threading.Event()
 
+# Seconds between roll-ups of all the unfinished documents, in between only documents with progress events are rolled up.
+DOC_PROGRESS_SWEEP_INTERVAL = int(os.environ.get("DOC_PROGRESS_SWEEP_INTERVAL", "60"))
+
 def update_progress():
+    last_sweep = 0
     while not stop_event.is_set():
         try:
-            DocumentService.update_progress()
-            stop_event.wait(6)
+            full = time.time() - last_sweep >= DOC_PROGRESS_SWEEP_INTERVAL
+            if full:
+                last_sweep = time.time()
+            DocumentService.update_progress(full)
+            stop_event.wait(1)
         except Exception:
             logging.exception("update_progress exception")
 
@@ -75,7 +82,8 @@ if __name__ == '__main__':
         f'project base: {utils.file_utils.get_project_base_directory()}'
     )
     show_configs()
-    settings.init_settings()
+    with log_startup_time("settings"):
+        settings.init_settings()
     print_rag_settings()
 
     # init db
@@ -16,9 +16,13 @@
 import os
 import os.path
 import logging
+import time
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 
 initialized_root_logger = False
+# Seconds spent loading each resource of this process, see log_startup_time()
+STARTUP_TIMES = {}
 
 def get_project_base_directory():
     PROJECT_BASE = os.path.abspath(
@@ -30,6 +34,18 @@ def get_project_base_directory():
     )
     return PROJECT_BASE
 
+@contextmanager
+def log_startup_time(name: str):
+    """
+    Time the cold loading of a resource (dictionary, model, ...) and log it, so that startup cost can be tracked per module.
+    """
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMES[name] = time.perf_counter() - st
+        logging.info(f"[STARTUP] {name} loaded in {STARTUP_TIMES[name]:.3f}s")
+
 def initRootLogger(logfile_basename: str, log_format: str = "%(asctime)-15s %(levelname)-8s %(process)d %(message)s"):
     global initialized_root_logger
     if initialized_root_logger:
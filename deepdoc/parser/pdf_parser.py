@@ -14,12 +14,16 @@
 #  limitations under the License.
 #
 
+import json
 import logging
 import os
 import random
 from timeit import default_timer as timer
 import sys
 import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import xgboost as xgb
 from io import BytesIO
@@ -27,12 +31,14 @@ import re
 import pdfplumber
 from PIL import Image
 import numpy as np
+import xxhash
 from pypdf import PdfReader as pdf2_read
 
 from api import settings
 from api.utils.file_utils import get_project_base_directory
 from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
 from rag.nlp import rag_tokenizer
+from rag.utils.redis_conn import REDIS_CONN
 from copy import deepcopy
 from huggingface_hub import snapshot_download
 
@@ -40,6 +46,121 @@ LOCK_KEY_pdfplumber = "global_shared_lock_pdfplumber"
 if LOCK_KEY_pdfplumber not in sys.modules:
     sys.modules[LOCK_KEY_pdfplumber] = threading.Lock()
 
+# Seconds the page count and outlines of a PDF are kept in Redis. They are computed when the document is split into
+# tasks, the tasks of its page ranges then don't parse the document structure again.
+PDF_META_CACHE_TTL = int(os.environ.get("PDF_META_CACHE_TTL", str(24 * 3600)))
+# Pages whose text crops are recognized in one batch, while the next pages are being detected.
+OCR_REC_BATCH_PAGES = int(os.environ.get("OCR_REC_BATCH_PAGES", "4"))
+# Page images kept decoded, the others are kept PNG-encoded and decoded again when used. 0 keeps every page decoded.
+PDF_PAGE_IMAGE_WINDOW = int(os.environ.get("PDF_PAGE_IMAGE_WINDOW", "8"))
+# Pages rendered ahead of the one being detected.
+PDF_RENDER_AHEAD_PAGES = int(os.environ.get("PDF_RENDER_AHEAD_PAGES", "2"))
+
+
+class PageImages:
+    """
+    The page images of a PDF with at most `window` of them decoded, the least recently used first dropped.
+    PNG is lossless, so the layout, table and crop steps see the same pixels as with the rendered images.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.encoded = []
+        self.decoded = OrderedDict()
+        self.lock = threading.Lock()
+
+    def append(self, img):
+        buf = BytesIO()
+        img.save(buf, format="PNG", compress_level=1)
+        with self.lock:
+            self.encoded.append(buf.getvalue())
+            self._keep(len(self.encoded) - 1, img)
+
+    def _keep(self, i, img):
+        self.decoded[i] = img
+        self.decoded.move_to_end(i)
+        while len(self.decoded) > self.window:
+            self.decoded.popitem(last=False)
+
+    def __len__(self):
+        return len(self.encoded)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        with self.lock:
+            img = self.decoded.get(i)
+            if img is None:
+                # opening only reads the header, the pixels are decoded when used
+                img = Image.open(BytesIO(self.encoded[i]))
+            self._keep(i, img)
+            return img
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _read_meta(binary):
+    # pypdf only reads the page tree and the outlines, without parsing any page
+    meta = {"total_page": None, "outlines": []}
+    try:
+        pdf = pdf2_read(BytesIO(binary))
+        try:
+            meta["total_page"] = len(pdf.pages)
+
+            def dfs(arr, depth):
+                for a in arr:
+                    if isinstance(a, dict):
+                        meta["outlines"].append((a["/Title"], depth))
+                        continue
+                    dfs(a, depth + 1)
+
+            try:
+                dfs(pdf.outline, 0)
+            except Exception as e:
+                logging.warning(f"Outlines exception: {e}")
+        finally:
+            pdf.close()
+    except Exception:
+        logging.exception("pdf_meta fails to read the PDF with pypdf")
+
+    if meta["total_page"] is None:
+        try:
+            with sys.modules[LOCK_KEY_pdfplumber]:
+                pdf = pdfplumber.open(BytesIO(binary))
+            meta["total_page"] = len(pdf.pages)
+            pdf.close()
+        except Exception:
+            logging.exception("total_page_number")
+    return meta
+
+
+def pdf_meta(fnm):
+    """
+    {"total_page": int or None, "outlines": [(title, depth), ...]} of a PDF given by path or content, cached per content.
+    """
+    binary = fnm
+    if isinstance(fnm, str):
+        with open(fnm, "rb") as f:
+            binary = f.read()
+    key = "pdf_meta:" + xxhash.xxh64(binary).hexdigest()
+    try:
+        meta = REDIS_CONN.get(key)
+        if meta:
+            meta = json.loads(meta)
+            return {"total_page": meta["total_page"], "outlines": [tuple(o) for o in meta["outlines"]]}
+    except Exception:
+        logging.exception("pdf_meta fails to read the cache")
+
+    meta = _read_meta(binary)
+    if meta["total_page"] is not None:
+        REDIS_CONN.set(key, json.dumps(meta, ensure_ascii=False), PDF_META_CACHE_TTL)
+    return meta
+
+
 class RAGFlowPdfParser:
     def __init__(self):
         self.ocr = OCR()
@@ -283,22 +404,25 @@ class RAGFlowPdfParser:
                 b["H_right"] = spans[ii]["x1"]
                 b["SP"] = ii
 
-    def __ocr(self, pagenum, img, chars, ZM=3):
+    def __ocr_detect(self, pagenum, img, chars, ZM=3):
+        """
+        Detects the text boxes of a page and fills them with the PDF's chars. Returns the boxes, None if there is none,
+        and the boxes left to recognize with their crop in "box_image".
+        """
         start = timer()
         bxs = self.ocr.detect(np.array(img))
         logging.info(f"__ocr detecting boxes of a image cost ({timer() - start}s)")
 
         start = timer()
         if not bxs:
-            self.boxes.append([])
-            return
+            return None, []
         bxs = [(line[0], line[1][0]) for line in bxs]
         bxs = Recognizer.sort_Y_firstly(
             [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
               "top": b[0][1] / ZM, "text": "", "txt": t,
               "bottom": b[-1][1] / ZM,
               "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[-1] / 3
+            self.mean_height[pagenum - 1] / 3
         )
         
         # merge chars in the same rect
@@ -320,7 +444,6 @@ class RAGFlowPdfParser:
                 bxs[ii]["text"] += c["text"]
 
         logging.info(f"__ocr sorting {len(chars)} chars cost {timer() - start}s")
-        start = timer()
         boxes_to_reg = []
         img_np = np.array(img)
         for b in bxs:
@@ -330,16 +453,29 @@ class RAGFlowPdfParser:
                 b["box_image"] = self.ocr.get_rotate_crop_image(img_np, np.array([[left, top], [right, top], [right, bott], [left, bott]], dtype=np.float32))
                 boxes_to_reg.append(b)
             del b["txt"]
-        texts = self.ocr.recognize_batch([b["box_image"] for b in boxes_to_reg])
+        return bxs, boxes_to_reg
+
+    def __ocr_recognize(self, pages):
+        """
+        Recognizes the crops of consecutive pages, [(pagenum, bxs, boxes_to_reg), ...], in one batch
+        and appends their boxes to self.boxes in page order.
+        """
+        start = timer()
+        boxes_to_reg = [b for _, _, bs in pages for b in bs]
+        texts = self.ocr.recognize_batch([b["box_image"] for b in boxes_to_reg]) if boxes_to_reg else []
         for i in range(len(boxes_to_reg)):
             boxes_to_reg[i]["text"] = texts[i]
             del boxes_to_reg[i]["box_image"]
-        logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s")
-        bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[-1] == 0:
-            self.mean_height[-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+        logging.info(f"__ocr recognize {len(boxes_to_reg)} boxes of {len(pages)} pages cost {timer() - start}s")
+        for pagenum, bxs, _ in pages:
+            if bxs is None:
+                self.boxes.append([])
+                continue
+            bxs = [b for b in bxs if b["text"]]
+            if self.mean_height[pagenum - 1] == 0:
+                self.mean_height[pagenum - 1] = np.median([b["bottom"] - b["top"]
+                                                           for b in bxs])
+            self.boxes.append(bxs)
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
@@ -954,15 +1090,34 @@ class RAGFlowPdfParser:
     @staticmethod
     def total_page_number(fnm, binary=None):
         try:
-            with sys.modules[LOCK_KEY_pdfplumber]:
-                pdf = pdfplumber.open(
-                    fnm) if not binary else pdfplumber.open(BytesIO(binary))
-            total_page = len(pdf.pages)
-            pdf.close()
-            return total_page 
+            return pdf_meta(binary if binary else fnm)["total_page"]
         except Exception:
             logging.exception("total_page_number")
 
+    def __render_pages(self, zoomin, rendered, stop):
+        # the only user of self.pdf while the pages are detected
+        def put(item):
+            while not stop.is_set():
+                try:
+                    rendered.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            for p in self.pdf.pages:
+                if stop.is_set():
+                    return
+                with sys.modules[LOCK_KEY_pdfplumber]:
+                    img = p.to_image(resolution=72 * zoomin).annotated
+                    # the characters were extracted already
+                    p.close()
+                self.page_images.append(img)
+                put(img)
+        except Exception as e:
+            logging.exception("RAGFlowPdfParser __render_pages")
+            put(e)
+
     def __images__(self, fnm, zoomin=3, page_from=0,
                    page_to=299, callback=None):
         self.lefted_chars = []
@@ -973,77 +1128,102 @@ class RAGFlowPdfParser:
         self.page_cum_height = [0]
         self.page_layout = []
         self.page_from = page_from
+        self.page_images = PageImages(PDF_PAGE_IMAGE_WINDOW) if PDF_PAGE_IMAGE_WINDOW > 0 else []
+        self.page_chars = []
+        self.pdf = None
         start = timer()
         try:
             with sys.modules[LOCK_KEY_pdfplumber]:
-                self.pdf = pdfplumber.open(fnm) if isinstance(
-                    fnm, str) else pdfplumber.open(BytesIO(fnm))
-                self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                    enumerate(self.pdf.pages[page_from:page_to])]
+                # only the pages of the range are loaded, the page count and outlines come from pdf_meta
+                pages = range(page_from + 1, page_to + 1)
+                self.pdf = pdfplumber.open(fnm, pages=pages) if isinstance(
+                    fnm, str) else pdfplumber.open(BytesIO(fnm), pages=pages)
                 try:
-                    self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in self.pdf.pages[page_from:page_to]]
+                    self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in self.pdf.pages]
                 except Exception as e:
                     logging.warning(f"Failed to extract characters for pages {page_from}-{page_to}: {str(e)}")
-                    self.page_chars = [[] for _ in range(page_to - page_from)]  # If failed to extract, using empty list instead.
-                    
-                self.total_page = len(self.pdf.pages)
+                    self.page_chars = [[] for _ in range(len(self.pdf.pages))]  # If failed to extract, using empty list instead.
         except Exception:
             logging.exception("RAGFlowPdfParser __images__")
+            if self.pdf is not None:
+                self.pdf.close()
+                self.pdf = None
         logging.info(f"__images__ dedupe_chars cost {timer() - start}s")
 
         self.outlines = []
         try:
-            self.pdf = pdf2_read(fnm if isinstance(fnm, str) else BytesIO(fnm))
-            outlines = self.pdf.outline
-
-            def dfs(arr, depth):
-                for a in arr:
-                    if isinstance(a, dict):
-                        self.outlines.append((a["/Title"], depth))
-                        continue
-                    dfs(a, depth + 1)
-
-            dfs(outlines, 0)
+            # usually computed when the document was split into tasks
+            meta = pdf_meta(fnm)
+            self.total_page = meta["total_page"]
+            self.outlines = meta["outlines"]
         except Exception as e:
             logging.warning(f"Outlines exception: {e}")
-        finally:
-            self.pdf.close()
         if not self.outlines:
             logging.warning("Miss outlines")
-        
 
         logging.debug("Images converted.")
         self.is_english = [re.search(r"[a-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}", "".join(
             random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
                            range(len(self.page_chars))]
         if sum([1 if e else 0 for e in self.is_english]) > len(
-                self.page_images) / 2:
+                self.page_chars) / 2:
             self.is_english = True
         else:
             self.is_english = False
 
         start = timer()
-        for i, img in enumerate(self.page_images):
-            chars = self.page_chars[i] if not self.is_english else []
-            self.mean_height.append(
-                np.median(sorted([c["height"] for c in chars])) if chars else 0
-            )
-            self.mean_width.append(
-                np.median(sorted([c["width"] for c in chars])) if chars else 8
-            )
-            self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
+        page_num = len(self.page_chars)
+        # the next pages are rendered while a page is detected, and recognition of a few pages runs in its own
+        # thread while the next pages are detected
+        rendered = queue.Queue(maxsize=max(1, PDF_RENDER_AHEAD_PAGES))
+        stop = threading.Event()
+        renderer = threading.Thread(target=self.__render_pages, args=(zoomin, rendered, stop), daemon=True)
+        rec_pool = ThreadPoolExecutor(max_workers=1)
+        rec_future = None
+        pending = []
+        try:
+            if self.pdf is not None:
+                renderer.start()
+            for i in range(page_num if self.pdf is not None else 0):
+                img = rendered.get()
+                if isinstance(img, Exception):
+                    raise img
+                chars = self.page_chars[i] if not self.is_english else []
+                self.mean_height.append(
+                    np.median(sorted([c["height"] for c in chars])) if chars else 0
+                )
+                self.mean_width.append(
+                    np.median(sorted([c["width"] for c in chars])) if chars else 8
+                )
+                self.page_cum_height.append(img.size[1] / zoomin)
+                j = 0
+                while j + 1 < len(chars):
+                    if chars[j]["text"] and chars[j + 1]["text"] \
+                            and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                            and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                                           chars[j]["width"]) / 2:
+                        chars[j]["text"] += " "
+                    j += 1
 
-            self.__ocr(i + 1, img, chars, zoomin)
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+                pending.append((i + 1, *self.__ocr_detect(i + 1, img, chars, zoomin)))
+                del img
+                if len(pending) >= OCR_REC_BATCH_PAGES or i + 1 == page_num:
+                    # at most one batch of crops waits while another is being recognized
+                    if rec_future:
+                        rec_future.result()
+                    rec_future = rec_pool.submit(self.__ocr_recognize, pending)
+                    pending = []
+                if callback and i % 6 == 5:
+                    callback(prog=(i + 1) * 0.6 / page_num, msg="")
+            if rec_future:
+                rec_future.result()
+        finally:
+            stop.set()
+            if renderer.is_alive():
+                renderer.join()
+            rec_pool.shutdown()
+            if self.pdf is not None:
+                self.pdf.close()
         logging.info(f"__images__ {len(self.page_images)} pages cost {timer() - start}s")
 
         if not self.is_english and not any(
@@ -16,6 +16,7 @@
 
 import logging
 import copy
+import threading
 import time
 import os
 
@@ -30,8 +31,10 @@ import cv2
 import onnxruntime as ort
 
 from .postprocess import build_post_process
+from .ort_runtime import session_options, cpu_session, TimedSession
 
 loaded_models = {}
+loaded_models_lock = threading.Lock()
 
 def transform(data, ops=None):
     """ transform """
@@ -67,7 +70,15 @@ def create_operators(op_param_list, global_config=None):
 
 
 def load_model(model_dir, nm):
+    """
+    Sessions are shared by all the OCR, layout and TSR recognizers of the process.
+    """
     model_file_path = os.path.join(model_dir, nm + ".onnx")
+    with loaded_models_lock:
+        return _load_model(model_file_path, nm)
+
+
+def _load_model(model_file_path, nm):
     global loaded_models
     loaded_model = loaded_models.get(model_file_path)
     if loaded_model:
@@ -87,11 +98,7 @@ def load_model(model_dir, nm):
             return False
         return False
 
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
+    options = session_options(nm)
 
     # https://github.com/microsoft/onnxruntime/issues/9509#issuecomment-951546580
     # Shrink GPU memory after execution
@@ -111,13 +118,10 @@ def load_model(model_dir, nm):
         run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "gpu:0")
         logging.info(f"load_model {model_file_path} uses GPU")
     else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
+        sess = cpu_session(model_file_path, nm, options)
         run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu")
-        logging.info(f"load_model {model_file_path} uses CPU")
-    loaded_model = (sess, run_options)
+        logging.info(f"load_model {model_file_path} uses CPU with {options.intra_op_num_threads} intra-op threads")
+    loaded_model = (TimedSession(sess, nm), run_options)
     loaded_models[model_file_path] = loaded_model
     return loaded_model
 
@@ -0,0 +1,138 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+ONNX Runtime settings of the deepdoc models and the latency of their inference.
+
+Every setting can be given for one model by suffixing the variable with the model name in upper case,
+e.g. DEEPDOC_ORT_INTRA_OP_THREADS_DET=4 for the text detector, or DEEPDOC_ORT_INTRA_OP_THREADS_LAYOUT_PAPER
+for "layout.paper".
+"""
+import bisect
+import logging
+import os
+import re
+import threading
+from timeit import default_timer as timer
+
+import onnxruntime as ort
+
+_GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket is unbounded.
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+# The histogram of a model is logged every this many runs, 0 never logs it.
+DEEPDOC_ORT_LATENCY_LOG_EVERY = int(os.environ.get("DEEPDOC_ORT_LATENCY_LOG_EVERY", "1000"))
+
+
+def _setting(name, model_name, default):
+    suffix = re.sub(r"[^A-Z0-9]", "_", model_name.upper())
+    return os.environ.get(f"{name}_{suffix}", os.environ.get(name, default))
+
+
+def session_options(model_name):
+    options = ort.SessionOptions()
+    options.enable_cpu_mem_arena = bool(int(_setting("DEEPDOC_ORT_CPU_MEM_ARENA", model_name, "0")))
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    # detection and recognition run at the same time, as do the parsers of the other tasks and worker processes,
+    # so a session keeps to a few threads unless given more
+    options.intra_op_num_threads = int(_setting("DEEPDOC_ORT_INTRA_OP_THREADS", model_name, "2"))
+    options.inter_op_num_threads = int(_setting("DEEPDOC_ORT_INTER_OP_THREADS", model_name, "2"))
+    options.graph_optimization_level = _GRAPH_OPT_LEVELS.get(
+        _setting("DEEPDOC_ORT_GRAPH_OPT_LEVEL", model_name, "all").lower(), ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    return options
+
+
+def cpu_session(model_file_path, model_name, options):
+    """
+    With DEEPDOC_ORT_OPTIMIZED_MODEL_DIR set, the graph optimized for this host is saved there on the first load
+    and loaded as it is afterwards, skipping the optimization at start-up.
+    """
+    cache_dir = _setting("DEEPDOC_ORT_OPTIMIZED_MODEL_DIR", model_name, "")
+    if not cache_dir or options.graph_optimization_level == ort.GraphOptimizationLevel.ORT_DISABLE_ALL:
+        return ort.InferenceSession(model_file_path, options=options, providers=['CPUExecutionProvider'])
+
+    level = [k for k, v in _GRAPH_OPT_LEVELS.items() if v == options.graph_optimization_level][0]
+    optimized = os.path.join(cache_dir, f"{model_name}.{level}.ort-{ort.__version__}.onnx")
+    if os.path.exists(optimized) and os.path.getmtime(optimized) >= os.path.getmtime(model_file_path):
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return ort.InferenceSession(optimized, options=options, providers=['CPUExecutionProvider'])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # other processes of the host may be loading the same model
+    tmp = f"{optimized}.{os.getpid()}.tmp"
+    options.optimized_model_filepath = tmp
+    sess = ort.InferenceSession(model_file_path, options=options, providers=['CPUExecutionProvider'])
+    try:
+        os.replace(tmp, optimized)
+    except OSError:
+        logging.exception(f"Fail to keep the optimized model of {model_file_path}")
+    return sess
+
+
+class LatencyHistogram:
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.runs = 0
+
+    def observe(self, ms):
+        with self.lock:
+            self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+            self.total_ms += ms
+            self.runs += 1
+            due = DEEPDOC_ORT_LATENCY_LOG_EVERY > 0 and self.runs % DEEPDOC_ORT_LATENCY_LOG_EVERY == 0
+        if due:
+            logging.info(f"deepdoc {self.model_name} latency: {self.summary()}")
+
+    def summary(self):
+        with self.lock:
+            buckets = ["<={}ms: {}".format(b, c) for b, c in zip(LATENCY_BUCKETS_MS, self.counts)]
+            buckets.append(">{}ms: {}".format(LATENCY_BUCKETS_MS[-1], self.counts[-1]))
+            return "runs: {}, mean: {:.1f}ms, {}".format(self.runs, self.total_ms / max(1, self.runs), ", ".join(buckets))
+
+
+_histograms = {}
+
+
+def latency_histograms():
+    return dict(_histograms)
+
+
+class TimedSession:
+    """
+    InferenceSession recording the latency of run() in the histogram of its model.
+    """
+
+    def __init__(self, sess, model_name):
+        self.sess = sess
+        self.histogram = _histograms.setdefault(model_name, LatencyHistogram(model_name))
+
+    def run(self, *args, **kwargs):
+        start = timer()
+        try:
+            return self.sess.run(*args, **kwargs)
+        finally:
+            self.histogram.observe((timer() - start) * 1000)
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
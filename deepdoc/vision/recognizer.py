@@ -409,18 +409,13 @@ class Recognizer(object):
 
     def __call__(self, image_list, thr=0.7, batch_size=16):
         res = []
-        imgs = []
-        for i in range(len(image_list)):
-            if not isinstance(image_list[i], np.ndarray):
-                imgs.append(np.array(image_list[i]))
-            else:
-                imgs.append(image_list[i])
-
-        batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
+        # the images are converted batch by batch, so only one batch of pages is held as arrays
+        batch_loop_cnt = math.ceil(float(len(image_list)) / batch_size)
         for i in range(batch_loop_cnt):
             start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(imgs))
-            batch_image_list = imgs[start_index:end_index]
+            end_index = min((i + 1) * batch_size, len(image_list))
+            batch_image_list = [image_list[j] if isinstance(image_list[j], np.ndarray) else np.array(image_list[j])
+                                for j in range(start_index, end_index)]
             inputs = self.preprocess(batch_image_list)
             logging.debug("preprocess")
             for ins in inputs:
@@ -14,8 +14,11 @@
 #  limitations under the License.
 #
 import itertools
+import logging
+import os
 import re
 import time
+from collections import defaultdict
 from dataclasses import dataclass
 from typing import Any, Callable
 
@@ -23,7 +26,7 @@ import networkx as nx
 import trio
 
 from graphrag.general.extractor import Extractor
-from rag.nlp import is_english
+from rag.nlp import is_english, is_chinese
 import editdistance
 from graphrag.entity_resolution_prompt import ENTITY_RESOLUTION_PROMPT
 from rag.llm.chat_model import Base as CompletionLLM
@@ -32,6 +35,13 @@ from graphrag.utils import perform_variable_replacements, chat_limiter
 DEFAULT_RECORD_DELIMITER = "##"
 DEFAULT_ENTITY_INDEX_DELIMITER = "<|>"
 DEFAULT_RESOLUTION_RESULT_DELIMITER = "&&"
+# A character or bigram shared by more entities of a type than this is too common to pair them up
+ENTITY_RESOLUTION_MAX_BLOCK = int(os.environ.get("ENTITY_RESOLUTION_MAX_BLOCK", "256"))
+# English names shorter than this may be within the edit distance of another name without sharing a bigram with it,
+# e.g. "cat" and "cut", so they are compared with every English name of a close length instead
+ENTITY_RESOLUTION_MIN_BLOCK_LEN = int(os.environ.get("ENTITY_RESOLUTION_MIN_BLOCK_LEN", "8"))
+# Candidate pairs asked about in one LLM request
+ENTITY_RESOLUTION_BATCH_SIZE = int(os.environ.get("ENTITY_RESOLUTION_BATCH_SIZE", "64"))
 
 
 @dataclass
@@ -92,14 +102,17 @@ class EntityResolution(Extractor):
 
         candidate_resolution = {entity_type: [] for entity_type in entity_types}
         for k, v in node_clusters.items():
-            candidate_resolution[k] = [(a, b) for a, b in itertools.combinations(v, 2) if self.is_similarity(a, b)]
+            candidate_resolution[k] = await trio.to_thread.run_sync(lambda: self._candidate_pairs(sorted(v)))
+        logging.info("Entity resolution: {} candidate pairs of {} entities".format(
+            sum([len(v) for v in candidate_resolution.values()]), len(nodes)))
 
+        # batches are built in a stable order so that their LLM answers are found in the cache on a rerun
         resolution_result = set()
         async with trio.open_nursery() as nursery:
-            for candidate_resolution_i in candidate_resolution.items():
-                if not candidate_resolution_i[1]:
-                    continue
-                nursery.start_soon(self._resolve_candidate(candidate_resolution_i, resolution_result))
+            for entity_type, pairs in candidate_resolution.items():
+                for i in range(0, len(pairs), ENTITY_RESOLUTION_BATCH_SIZE):
+                    nursery.start_soon(self._resolve_candidate,
+                                       (entity_type, pairs[i:i + ENTITY_RESOLUTION_BATCH_SIZE]), resolution_result)
 
         connect_graph = nx.Graph()
         removed_entities = []
@@ -200,10 +213,50 @@ class EntityResolution(Extractor):
 
         return ans_list
 
+    @staticmethod
+    def _blocking_keys(name):
+        """
+        Chinese characters and the character bigrams of other words. Apart from short English names,
+        entities can only be paired through one of them.
+        """
+        name = name.lower()
+        keys = set([ch for ch in name if is_chinese(ch)])
+        for w in re.findall(r"[^\W\u4e00-\u9fff_]+", name):
+            if len(w) < 2:
+                keys.add(w)
+                continue
+            keys.update([w[i:i + 2] for i in range(len(w) - 1)])
+        return keys
+
+    def _candidate_pairs(self, names):
+        blocks = defaultdict(list)
+        english_by_len = defaultdict(list)
+        short = []
+        for i, n in enumerate(names):
+            for k in self._blocking_keys(n):
+                blocks[k].append(i)
+            if is_english(n):
+                english_by_len[len(n)].append(i)
+                if len(n) < ENTITY_RESOLUTION_MIN_BLOCK_LEN:
+                    short.append(i)
+        pairs = set()
+        for members in blocks.values():
+            if len(members) < 2 or len(members) > ENTITY_RESOLUTION_MAX_BLOCK:
+                continue
+            pairs.update(itertools.combinations(members, 2))
+        for a in short:
+            # is_similarity rejects names longer than this one by more than half of its length
+            la = len(names[a])
+            for lb in range(la, la + la // 2 + 1):
+                pairs.update([(min(a, b), max(a, b)) for b in english_by_len.get(lb, []) if b != a])
+        return [(names[a], names[b]) for a, b in sorted(pairs) if self.is_similarity(names[a], names[b])]
+
     def is_similarity(self, a, b):
         if is_english(a) and is_english(b):
-            if editdistance.eval(a, b) <= min(len(a), len(b)) // 2:
-                return True
+            # the length gap alone may already exceed the allowed distance
+            if abs(len(a) - len(b)) > min(len(a), len(b)) // 2:
+                return False
+            return editdistance.eval(a, b) <= min(len(a), len(b)) // 2
 
         if len(set(a) & set(b)) > 0:
             return True
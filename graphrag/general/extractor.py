@@ -51,6 +51,7 @@ class Extractor:
         self._set_entity_ = set_entity
         self._get_relation_ = get_relation
         self._set_relation_ = set_relation
+        self._entity_locks = defaultdict(trio.Lock)
 
     def _chat(self, system, history, gen_conf):
         hist = deepcopy(history)
@@ -178,7 +179,7 @@ class Extractor:
             source_id=already_source_ids,
         )
         node_data["entity_name"] = entity_name
-        self._set_entity_(entity_name, node_data)
+        await trio.to_thread.run_sync(lambda: self._set_entity_(entity_name, node_data))
         all_relationships_data.append(node_data)
 
     async def _merge_edges(
@@ -210,13 +211,15 @@ class Extractor:
         source_id = flat_uniq_list(edges_data, "source_id") + already_source_ids
 
         for need_insert_id in [src_id, tgt_id]:
-            if self._get_entity_(need_insert_id):
-                continue
-            self._set_entity_(need_insert_id, {
-                        "source_id": source_id,
-                        "description": description,
-                        "entity_type": 'UNKNOWN'
-                    })
+            # edges sharing an endpoint are merged concurrently, only the first one inserts its placeholder
+            async with self._entity_locks[need_insert_id]:
+                if self._get_entity_(need_insert_id):
+                    continue
+                await trio.to_thread.run_sync(lambda: self._set_entity_(need_insert_id, {
+                            "source_id": source_id,
+                            "description": description,
+                            "entity_type": 'UNKNOWN'
+                        }))
         description = await self._handle_entity_relation_summary(
             f"({src_id}, {tgt_id})", description
         )
@@ -228,7 +231,7 @@ class Extractor:
             weight=weight,
             source_id=source_id
         )
-        self._set_relation_(src_id, tgt_id, edge_data)
+        await trio.to_thread.run_sync(lambda: self._set_relation_(src_id, tgt_id, edge_data))
         all_relationships_data.append(edge_data)
 
     async def _handle_entity_relation_summary(
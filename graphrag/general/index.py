@@ -71,12 +71,14 @@ class Dealer:
                 #description=rel["description"]
             )
 
+        # only the entities touched by these documents need their n-hop paths recomputed
+        dirty_nodes = set(self.graph.nodes)
         with RedisDistributedLock(self.kb_id, 60*60):
             old_graph, old_doc_ids = get_graph(self.tenant_id, self.kb_id)
             if old_graph is not None:
                 logging.info("Merge with an exiting graph...................")
                 self.graph = reduce(graph_merge, [old_graph, self.graph])
-            update_nodes_pagerank_nhop_neighbour(self.tenant_id, self.kb_id, self.graph, 2)
+            update_nodes_pagerank_nhop_neighbour(self.tenant_id, self.kb_id, self.graph, 2, dirty_nodes)
             if old_doc_ids:
                 docids.extend(old_doc_ids)
                 docids = list(set(docids))
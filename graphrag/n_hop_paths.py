@@ -0,0 +1,98 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Bounded-hop path enumeration for the n_hop_with_weight field of entities.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Max neighbours a path is extended with at each hop after the first, heaviest edges first. 0 means no limit.
+GRAPH_NHOP_MAX_FANOUT = int(os.environ.get("GRAPH_NHOP_MAX_FANOUT", "0"))
+# Worker processes enumerating paths, 0 runs in the calling thread.
+GRAPH_NHOP_PROCESSES = int(os.environ.get("GRAPH_NHOP_PROCESSES", "0"))
+# Below this many start nodes the worker processes aren't worth their start-up.
+GRAPH_NHOP_PARALLEL_MIN = 2048
+
+
+def _edge_used(path, a, b):
+    for i in range(len(path) - 1):
+        if (path[i] == a and path[i + 1] == b) or (path[i] == b and path[i + 1] == a):
+            return True
+    return False
+
+
+def _paths_from(adj, wts, start, n_hop, max_fanout):
+    paths = [(start, nbr) for nbr in adj.get(start, [])]
+    for _ in range(n_hop - 1):
+        extended = []
+        for path in paths:
+            last = path[-1]
+            if last in path[:-1]:
+                # the path already loops back
+                extended.append(path)
+                continue
+            nbrs = adj.get(last, [])
+            if max_fanout and len(nbrs) > max_fanout:
+                nbrs = sorted(nbrs, key=lambda x: wts.get((last, x), wts.get((x, last), 0)), reverse=True)[:max_fanout]
+            grown = False
+            for nbr in nbrs:
+                if _edge_used(path, last, nbr):
+                    continue
+                extended.append(path + (nbr,))
+                grown = True
+            if not grown:
+                extended.append(path)
+        paths = extended
+
+    return [{"path": path, "weights": [wts.get((path[i], path[i + 1]), 0) for i in range(len(path) - 1)]}
+            for path in paths]
+
+
+_worker_graph = None
+
+
+def _init_worker(adj, wts, n_hop, max_fanout):
+    global _worker_graph
+    _worker_graph = (adj, wts, n_hop, max_fanout)
+
+
+def _worker_paths(starts):
+    adj, wts, n_hop, max_fanout = _worker_graph
+    return [(n, _paths_from(adj, wts, n, n_hop, max_fanout)) for n in starts]
+
+
+def n_hop_paths(graph, nodes, n_hop, max_fanout=GRAPH_NHOP_MAX_FANOUT, processes=GRAPH_NHOP_PROCESSES):
+    """
+    Paths of up to `n_hop` edges starting at each of `nodes`, as {node: [{"path": (...), "weights": [...]}, ...]}.
+    A path doesn't take an edge twice and stops once it reaches a node it already went through.
+    Adjacency and edge weights are read from the graph once; weights are looked up in the edge orientation
+    networkx reports, a missing one counts as 0.
+    """
+    adj = {n: list(nbrs) for n, nbrs in graph.adjacency()}
+    wts = {(f, t): d["weight"] for f, t, d in graph.edges(data=True) if "weight" in d}
+    nodes = list(nodes)
+
+    if processes <= 0 or len(nodes) < GRAPH_NHOP_PARALLEL_MIN:
+        return {n: _paths_from(adj, wts, n, n_hop, max_fanout) for n in nodes}
+
+    bs = max(256, (len(nodes) + processes * 4 - 1) // (processes * 4))
+    res = {}
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(adj, wts, n_hop, max_fanout)) as pool:
+        for part in pool.map(_worker_paths, [nodes[i:i + bs] for i in range(0, len(nodes), bs)]):
+            res.update(part)
+    return res
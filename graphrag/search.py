@@ -108,9 +108,9 @@ class KGSearch(Dealer):
         filters = deepcopy(filters)
         filters["knowledge_graph_kwd"] = "entity"
         matchDense = self.get_vector(", ".join(keywords), emb_mdl, 1024, sim_thr)
-        es_res = self.dataStore.search(["content_with_weight", "entity_kwd", "rank_flt"], [], filters, [matchDense],
-                                       OrderByExpr(), 0, N,
-                                       idxnms, kb_ids)
+        es_res = self.dataStore.search(["content_with_weight", "entity_kwd", "rank_flt", "n_hop_with_weight"], [],
+                                       filters, [matchDense], OrderByExpr(), 0, N,
+                                       idxnms, kb_ids, track_total_hits=False)
         return self._ent_info_from_(es_res, sim_thr)
 
     def get_relevant_relations_by_txt(self, txt, filters, idxnms, kb_ids, emb_mdl, sim_thr=0.3, N=56):
@@ -121,7 +121,7 @@ class KGSearch(Dealer):
         matchDense = self.get_vector(txt, emb_mdl, 1024, sim_thr)
         es_res = self.dataStore.search(
             ["content_with_weight", "_score", "from_entity_kwd", "to_entity_kwd", "weight_int"],
-            [], filters, [matchDense], OrderByExpr(), 0, N, idxnms, kb_ids)
+            [], filters, [matchDense], OrderByExpr(), 0, N, idxnms, kb_ids, track_total_hits=False)
         return self._relation_info_from_(es_res, sim_thr)
 
     def get_relevant_ents_by_types(self, types, filters, idxnms, kb_ids, N=56):
@@ -133,7 +133,7 @@ class KGSearch(Dealer):
         ordr = OrderByExpr()
         ordr.desc("rank_flt")
         es_res = self.dataStore.search(["entity_kwd", "rank_flt"], [], filters, [], ordr, 0, N,
-                                       idxnms, kb_ids)
+                                       idxnms, kb_ids, track_total_hits=False)
         return self._ent_info_from_(es_res, 0)
 
     def retrieval(self, question: str,
@@ -295,7 +295,7 @@ class KGSearch(Dealer):
         fltr["knowledge_graph_kwd"] = "community_report"
         fltr["entities_kwd"] = entities
         comm_res = self.dataStore.search(fields, [], fltr, [],
-                                         OrderByExpr(), 0, topn, idxnms, kb_ids)
+                                         OrderByExpr(), 0, topn, idxnms, kb_ids, track_total_hits=False)
         comm_res_fields = self.dataStore.getFields(comm_res, fields)
         txts = []
         for ii, (_, row) in enumerate(comm_res_fields.items()):
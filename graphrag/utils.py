@@ -12,18 +12,18 @@ import logging
 import re
 import time
 from collections import defaultdict
-from copy import deepcopy
 from hashlib import md5
 from typing import Any, Callable
 import os
 import trio
 
 import networkx as nx
-import numpy as np
 import xxhash
 from networkx.readwrite import json_graph
 
 from api import settings
+from graphrag.n_hop_paths import n_hop_paths
+from rag.llm.embedding_cache import get_embeddings, set_embeddings
 from rag.nlp import search, rag_tokenizer
 from rag.utils.doc_store_conn import OrderByExpr
 from rag.utils.redis_conn import REDIS_CONN
@@ -31,6 +31,10 @@ from rag.utils.redis_conn import REDIS_CONN
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
 chat_limiter = trio.CapacityLimiter(int(os.environ.get('MAX_CONCURRENT_CHATS', 100)))
+# Relative pagerank change under which an entity's stored rank_flt is left as it is after a merge
+GRAPH_PAGERANK_RTOL = float(os.environ.get('GRAPH_PAGERANK_RTOL', "0.01"))
+# Entity and relation names are embedded again on every merge, their vectors stay in Redis whatever EMBEDDING_CACHE_TTL is
+GRAPHRAG_EMBED_CACHE_TTL = 24 * 3600
 
 def perform_variable_replacements(
     input: str, history: list[dict] | None = None, variables: dict | None = None
@@ -107,25 +111,11 @@ def set_llm_cache(llmnm, txt, v, history, genconf):
 
 
 def get_embed_cache(llmnm, txt):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return np.array(json.loads(bin))
+    return get_embeddings(llmnm, [txt], GRAPHRAG_EMBED_CACHE_TTL)[0]
 
 
 def set_embed_cache(llmnm, txt, arr):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    arr = json.dumps(arr.tolist() if isinstance(arr, np.ndarray) else arr)
-    REDIS_CONN.set(k, arr.encode("utf-8"), 24*3600)
+    set_embeddings(llmnm, [txt], [arr], GRAPHRAG_EMBED_CACHE_TTL)
 
 
 def get_tags_from_cache(kb_ids):
@@ -243,7 +233,8 @@ def get_entity(tenant_id, kb_id, ent_name):
         "fields": ["content_with_weight"],
         "entity_kwd": ent_name,
         "size": 10000,
-        "knowledge_graph_kwd": ["entity"]
+        "knowledge_graph_kwd": ["entity"],
+        "track_total_hits": False
     }
     res = []
     es_res = settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id])
@@ -272,7 +263,7 @@ def set_entity(tenant_id, kb_id, embd_mdl, ent_name, meta):
         "available_int": 0
     }
     chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
-    res = settings.retrievaler.search({"entity_kwd": ent_name, "size": 1, "fields": []},
+    res = settings.retrievaler.search({"entity_kwd": ent_name, "size": 1, "fields": [], "track_total_hits": False},
                                       search.index_name(tenant_id), [kb_id])
     if res.ids:
         settings.docStoreConn.update({"entity_kwd": ent_name}, chunk, search.index_name(tenant_id), kb_id)
@@ -303,7 +294,8 @@ def get_relation(tenant_id, kb_id, from_ent_name, to_ent_name, size=1):
         "size": size,
         "from_entity_kwd": ents,
         "to_entity_kwd": ents,
-        "knowledge_graph_kwd": ["relation"]
+        "knowledge_graph_kwd": ["relation"],
+        "track_total_hits": False
     }
     res = []
     es_res = settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id] if isinstance(kb_id, str) else kb_id)
@@ -331,7 +323,7 @@ def set_relation(tenant_id, kb_id, embd_mdl, from_ent_name, to_ent_name, meta):
         "available_int": 0
     }
     chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
-    res = settings.retrievaler.search({"from_entity_kwd": to_ent_name, "to_entity_kwd": to_ent_name, "size": 1, "fields": []},
+    res = settings.retrievaler.search({"from_entity_kwd": to_ent_name, "to_entity_kwd": to_ent_name, "size": 1, "fields": [], "track_total_hits": False},
                                       search.index_name(tenant_id), [kb_id])
 
     if res.ids:
@@ -358,7 +350,8 @@ def get_graph(tenant_id, kb_id):
         "fields": ["content_with_weight", "source_id"],
         "removed_kwd": "N",
         "size": 1,
-        "knowledge_graph_kwd": ["graph"]
+        "knowledge_graph_kwd": ["graph"],
+        "track_total_hits": False
     }
     res = settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id])
     for id in res.ids:
@@ -373,14 +366,14 @@ def get_graph(tenant_id, kb_id):
 def set_graph(tenant_id, kb_id, graph, docids):
     chunk = {
         "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False,
-                                          indent=2),
+                                          separators=(",", ":")),
         "knowledge_graph_kwd": "graph",
         "kb_id": kb_id,
         "source_id": list(docids),
         "available_int": 0,
         "removed_kwd": "N"
     }
-    res = settings.retrievaler.search({"knowledge_graph_kwd": "graph", "size": 1, "fields": []}, search.index_name(tenant_id), [kb_id])
+    res = settings.retrievaler.search({"knowledge_graph_kwd": "graph", "size": 1, "fields": [], "track_total_hits": False}, search.index_name(tenant_id), [kb_id])
     if res.ids:
         settings.docStoreConn.update({"knowledge_graph_kwd": "graph"}, chunk,
                                      search.index_name(tenant_id), kb_id)
@@ -388,84 +381,83 @@ def set_graph(tenant_id, kb_id, graph, docids):
         settings.docStoreConn.insert([{"id": chunk_id(chunk), **chunk}], search.index_name(tenant_id), kb_id)
 
 
-def is_continuous_subsequence(subseq, seq):
-    def find_all_indexes(tup, value):
-        indexes = []
-        start = 0
+def get_entity_chunk_ids(tenant_id, kb_id, ent_names, bs=1024):
+    """
+    Ids of the entity chunks of the given entities, by entity name.
+    """
+    res = defaultdict(list)
+    for b in range(0, len(ent_names), bs):
+        conds = {"entity_kwd": ent_names[b:b + bs], "knowledge_graph_kwd": ["entity"]}
+        offset = 0
         while True:
-            try:
-                index = tup.index(value, start)
-                indexes.append(index)
-                start = index + 1
-            except ValueError:
+            es_res = settings.docStoreConn.search(["entity_kwd"], [], conds, [], OrderByExpr(), offset, bs,
+                                                  search.index_name(tenant_id), [kb_id], track_total_hits=False)
+            es_res = settings.docStoreConn.getFields(es_res, ["entity_kwd"])
+            for id, d in es_res.items():
+                ent_name = d.get("entity_kwd")
+                if isinstance(ent_name, list):
+                    ent_name = ent_name[0]
+                res[ent_name].append(id)
+            if len(es_res) < bs:
                 break
-        return indexes
-
-    index_list = find_all_indexes(seq,subseq[0])
-    for idx in index_list:
-        if idx!=len(seq)-1:
-            if seq[idx+1]==subseq[-1]:
-                return True
-    return False
-
-
-def merge_tuples(list1, list2):
-    result = []
-    for tup in list1:
-        last_element = tup[-1]
-        if last_element in tup[:-1]:
-            result.append(tup)
-        else:
-            matching_tuples = [t for t in list2 if t[0] == last_element]
-            already_match_flag = 0
-            for match in matching_tuples:
-                matchh = (match[1], match[0])
-                if is_continuous_subsequence(match, tup) or is_continuous_subsequence(matchh, tup):
-                    continue
-                already_match_flag = 1
-                merged_tuple = tup + match[1:]
-                result.append(merged_tuple)
-            if not already_match_flag:
-                result.append(tup)
-    return result
-
+            offset += bs
+    return res
 
-def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
-    def n_neighbor(id):
-        nonlocal graph, n_hop
-        count = 0
-        source_edge = list(graph.edges(id))
-        if not source_edge:
-            return []
-        count = count + 1
-        while count < n_hop:
-            count = count + 1
-            sc_edge = deepcopy(source_edge)
-            source_edge = []
-            for pair in sc_edge:
-                append_edge = list(graph.edges(pair[-1]))
-                for tuples in merge_tuples([pair], append_edge):
-                    source_edge.append(tuples)
-        nbrs = []
-        for path in source_edge:
-            n = {"path": path, "weights": []}
-            wts = nx.get_edge_attributes(graph, 'weight')
-            for i in range(len(path)-1):
-                f, t = path[i], path[i+1]
-                n["weights"].append(wts.get((f, t), 0))
-            nbrs.append(n)
-        return nbrs
 
+def nodes_within_hops(graph, nodes, hops):
+    """
+    The given nodes and every node reachable from them in at most `hops` edges.
+    """
+    seen = set([n for n in nodes if n in graph])
+    frontier = list(seen)
+    for _ in range(hops):
+        nxt = []
+        for n in frontier:
+            for nbr in graph.neighbors(n):
+                if nbr not in seen:
+                    seen.add(nbr)
+                    nxt.append(nbr)
+        frontier = nxt
+    return seen
+
+
+def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop, dirty_nodes=None):
+    """
+    Store pagerank and n-hop paths of the entities. With `dirty_nodes`, the nodes a merge touched, only entities
+    whose n-hop paths may have changed get them recomputed, and pagerank is only written where it moved noticeably.
+    """
     pr = nx.pagerank(graph)
+    # an n-hop path through a changed edge starts at most n_hop-1 edges away from it
+    nhop_nodes = set(graph.nodes) if dirty_nodes is None else nodes_within_hops(graph, dirty_nodes, n_hop - 1)
+    nhop_paths = n_hop_paths(graph, nhop_nodes, n_hop)
+    updates = {}
     for n, p in pr.items():
-        graph.nodes[n]["pagerank"] = p
-        try:
-            settings.docStoreConn.update({"entity_kwd": n, "kb_id": kb_id},
-                                         {"rank_flt": p,
-                                          "n_hop_with_weight": json.dumps(n_neighbor(n), ensure_ascii=False)},
-                                         search.index_name(tenant_id), kb_id)
-        except Exception as e:
-            logging.exception(e)
+        # the rank last written to the doc store, so that small moves can't add up unnoticed
+        old_p = graph.nodes[n].get("pagerank")
+        upd = {}
+        if n in nhop_nodes or old_p is None or abs(p - old_p) > GRAPH_PAGERANK_RTOL * old_p:
+            upd["rank_flt"] = p
+        if n in nhop_nodes:
+            upd["n_hop_with_weight"] = json.dumps(nhop_paths[n], ensure_ascii=False)
+        if upd:
+            updates[n] = upd
+    logging.info(f"Update pagerank/n-hop of {len(updates)}/{len(pr)} entities, {len(nhop_nodes)} with new n-hop paths.")
+
+    ent_chunk_ids = get_entity_chunk_ids(tenant_id, kb_id, list(updates.keys()))
+    rows = []
+    for n, upd in updates.items():
+        for id in ent_chunk_ids.get(n, []):
+            rows.append({"id": id, **upd})
+    try:
+        errors = settings.docStoreConn.updateBulk(rows, search.index_name(tenant_id), kb_id)
+        if errors:
+            logging.error(f"Fail to update pagerank of {len(errors)} entities, e.g. {errors[0]}")
+        else:
+            for n, upd in updates.items():
+                if "rank_flt" in upd:
+                    graph.nodes[n]["pagerank"] = upd["rank_flt"]
+    except Exception as e:
+        logging.exception(e)
 
     ty2ents = defaultdict(list)
     for p, r in sorted(pr.items(), key=lambda x: x[1], reverse=True):
@@ -480,7 +472,7 @@ def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
         "knowledge_graph_kwd": "ty2ents",
         "available_int": 0
     }
-    res = settings.retrievaler.search({"knowledge_graph_kwd": "ty2ents", "size": 1, "fields": []},
+    res = settings.retrievaler.search({"knowledge_graph_kwd": "ty2ents", "size": 1, "fields": [], "track_total_hits": False},
                                       search.index_name(tenant_id), [kb_id])
     if res.ids:
         settings.docStoreConn.update({"knowledge_graph_kwd": "ty2ents"},
@@ -532,11 +524,15 @@ def rebuild_graph(tenant_id, kb_id):
                                  {"kb_id": kb_id, "knowledge_graph_kwd": ["entity", "relation"]},
                                  [],
                                  OrderByExpr(),
-                                 i, bs, search.index_name(tenant_id), [kb_id]
+                                 i, bs, search.index_name(tenant_id), [kb_id],
+                                 track_total_hits=False
                                  )
+        # without the total, an empty page after the first only means the previous page was the last one
         tot = settings.docStoreConn.getTotal(es_res)
         if tot == 0:
-            return None, None
+            if i == 0:
+                return None, None
+            break
 
         es_res = settings.docStoreConn.getFields(es_res, flds)
         for id, d in es_res.items():
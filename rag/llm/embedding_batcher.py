@@ -0,0 +1,141 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# Max time (ms) an encode request waits for other requests to fill up a batch. 0 disables micro-batching.
+EMBEDDING_BATCH_WAIT_MS = int(os.environ.get("EMBEDDING_BATCH_WAIT_MS", "0"))
+# Batches of one model sent to it at the same time.
+EMBEDDING_BATCH_CONCURRENCY = int(os.environ.get("EMBEDDING_BATCH_CONCURRENCY", "4"))
+
+
+class _EncodeRequest:
+    __slots__ = ("texts", "future", "vectors", "used_tokens", "pending")
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.future = Future()
+        self.vectors = [None] * len(texts)
+        self.used_tokens = 0.0
+        self.pending = len(texts)
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces encode requests from all threads of the process into full batches for one embedding model.
+    A batch is sent when it is full or when the oldest request has waited `max_wait` seconds.
+    Texts are taken round-robin across tenants so that one big document can't starve the others.
+    """
+
+    def __init__(self, mdl, max_batch_size=16, max_wait=0.01, concurrency=1):
+        self.mdl = mdl
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.queues = OrderedDict()
+        self.size = 0
+        self.cond = threading.Condition()
+        # each thread forms and sends its own batches, so a slow request doesn't hold up the others
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(1, concurrency))]
+        for t in self.threads:
+            t.start()
+
+    def encode(self, tenant_id, texts: list):
+        if not texts:
+            return self.mdl.encode(texts)
+        req = _EncodeRequest(texts)
+        with self.cond:
+            self.queues.setdefault(tenant_id, deque()).extend([(req, i) for i in range(len(texts))])
+            self.size += len(texts)
+            self.cond.notify()
+        return req.future.result()
+
+    def _take(self):
+        batch = []
+        while len(batch) < self.max_batch_size and self.queues:
+            for tenant_id in list(self.queues.keys()):
+                q = self.queues[tenant_id]
+                batch.append(q.popleft())
+                if not q:
+                    del self.queues[tenant_id]
+                else:
+                    # served tenants go behind those not served yet, even if the round is cut short
+                    self.queues.move_to_end(tenant_id)
+                if len(batch) >= self.max_batch_size:
+                    break
+        self.size -= len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.size == 0:
+                    self.cond.wait()
+                deadline = time.monotonic() + self.max_wait
+                while self.size < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self._take()
+
+            texts = [req.texts[i] for req, i in batch]
+            try:
+                vts, used_tokens = self.mdl.encode(texts)
+                if len(vts) != len(texts):
+                    raise Exception("Embedding model returned {} vectors for {} texts".format(len(vts), len(texts)))
+            except Exception as e:
+                logging.exception("EmbeddingBatcher encode got exception")
+                for req, _ in batch:
+                    if not req.future.done():
+                        req.future.set_exception(e)
+                continue
+
+            # token usage is shared out by text length
+            total_len = sum([len(t) for t in texts]) or 1
+            for (req, i), v, t in zip(batch, vts, texts):
+                if req.future.done():
+                    continue
+                req.vectors[i] = v
+                req.used_tokens += used_tokens * len(t) / total_len
+                req.pending -= 1
+                if req.pending == 0:
+                    req.future.set_result((np.array(req.vectors), int(round(req.used_tokens))))
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(model_config: dict, mdl):
+    """
+    Return the process-wide batcher for the model identified by `model_config`, None if micro-batching is off.
+    Requests are only coalesced when they go to the same model with the same credential.
+    """
+    if EMBEDDING_BATCH_WAIT_MS <= 0:
+        return None
+    key = (model_config.get("llm_factory"), model_config.get("llm_name"),
+           model_config.get("api_base"), model_config.get("api_key"))
+    with _batchers_lock:
+        if key not in _batchers:
+            _batchers[key] = EmbeddingBatcher(mdl, getattr(mdl, "max_batch_size", 16), EMBEDDING_BATCH_WAIT_MS / 1000.,
+                                              EMBEDDING_BATCH_CONCURRENCY)
+        return _batchers[key]
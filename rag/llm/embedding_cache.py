@@ -0,0 +1,127 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Two-tier cache of text embeddings: an in-process LRU in front of Redis.
+Vectors are stored in Redis as raw float16/float32 bytes, fetched with one MGET and written with one pipeline per batch.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+
+# Bump when the stored format changes, entries written by older versions are then ignored.
+EMBEDDING_CACHE_VERSION = 1
+# The cache is off unless one of its tiers is enabled: parsing documents embeds every chunk once, so caching
+# those vectors mostly costs memory, and Redis also holds the task queue.
+# Vectors kept in the process, 0 disables the in-process tier.
+EMBEDDING_CACHE_LRU_SIZE = int(os.environ.get("EMBEDDING_CACHE_LRU_SIZE", "0"))
+# Seconds a vector is kept in Redis, 0 disables the Redis tier.
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", "0"))
+# float32 or float16, float16 halves Redis memory at the cost of precision.
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")
+
+_DTYPES = {b"4": np.float32, b"2": np.float16}
+_DTYPE_TAGS = {"float32": b"4", "float16": b"2"}
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+def embedding_cache_enabled():
+    return EMBEDDING_CACHE_LRU_SIZE > 0 or EMBEDDING_CACHE_TTL > 0
+
+
+def embedding_model_key(model_config: dict):
+    """
+    Identifies the vector space of a model: the same model name served from another endpoint may embed differently.
+    """
+    return "{}/{}/{}".format(model_config.get("llm_factory", ""), model_config.get("llm_name", ""),
+                             model_config.get("api_base", "") or "")
+
+
+def _cache_key(model_key, txt):
+    hasher = xxhash.xxh64()
+    hasher.update(str(model_key).encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(str(txt).encode("utf-8"))
+    return "embd:{}:{}".format(EMBEDDING_CACHE_VERSION, hasher.hexdigest())
+
+
+def _dumps(v):
+    tag = _DTYPE_TAGS.get(EMBEDDING_CACHE_DTYPE, b"4")
+    return tag + np.asarray(v, dtype=_DTYPES[tag]).tobytes()
+
+
+def _loads(b):
+    dtype = _DTYPES.get(b[:1])
+    if dtype is None:
+        return None
+    return np.frombuffer(b[1:], dtype=dtype).astype(np.float32)
+
+
+def get_embeddings(model_key, texts: list, ttl=None):
+    """
+    Cached vectors for `texts` in order, None for the texts not cached.
+    `ttl` overrides EMBEDDING_CACHE_TTL for callers keeping their own entries in Redis.
+    """
+    ttl = EMBEDDING_CACHE_TTL if ttl is None else ttl
+    keys = [_cache_key(model_key, t) for t in texts]
+    res = [None] * len(texts)
+    if EMBEDDING_CACHE_LRU_SIZE > 0:
+        with _lru_lock:
+            for i, k in enumerate(keys):
+                v = _lru.get(k)
+                if v is not None:
+                    _lru.move_to_end(k)
+                    res[i] = v
+
+    missing = [i for i, v in enumerate(res) if v is None]
+    if not missing or ttl <= 0:
+        return res
+    fetched = {}
+    for i, b in zip(missing, REDIS_CONN.mget_bin([keys[i] for i in missing])):
+        v = _loads(b) if b else None
+        if v is None or not len(v):
+            continue
+        res[i] = v
+        fetched[keys[i]] = v
+    _lru_put(fetched)
+    return res
+
+
+def set_embeddings(model_key, texts: list, vectors, ttl=None):
+    if not len(texts):
+        return
+    ttl = EMBEDDING_CACHE_TTL if ttl is None else ttl
+    keys = [_cache_key(model_key, t) for t in texts]
+    _lru_put({k: np.array(v, dtype=np.float32) for k, v in zip(keys, vectors)})
+    if ttl > 0:
+        REDIS_CONN.mset_bin({k: _dumps(v) for k, v in zip(keys, vectors)}, ttl)
+
+
+def _lru_put(items: dict):
+    if EMBEDDING_CACHE_LRU_SIZE <= 0 or not items:
+        return
+    with _lru_lock:
+        for k, v in items.items():
+            _lru[k] = v
+            _lru.move_to_end(k)
+        while len(_lru) > EMBEDDING_CACHE_LRU_SIZE:
+            _lru.popitem(last=False)
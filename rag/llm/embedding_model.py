@@ -35,6 +35,10 @@ import json
 
 
 class Base(ABC):
+    # Max number of texts per encode request, and max total tokens per request (0 means unlimited).
+    max_batch_size = 16
+    max_batch_tokens = 0
+
     def __init__(self, key, model_name):
         pass
 
@@ -178,13 +182,15 @@ class BaiChuanEmbed(OpenAIEmbed):
 
 
 class QWenEmbed(Base):
+    max_batch_size = 4
+
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         self.key = key
         self.model_name = model_name
 
     def encode(self, texts: list):
         import dashscope
-        batch_size = 4
+        batch_size = self.max_batch_size
         try:
             res = []
             token_count = 0
@@ -341,6 +347,7 @@ class XinferenceEmbed(Base):
 
 class YoudaoEmbed(Base):
     _client = None
+    max_batch_size = 10
 
     def __init__(self, key=None, model_name="maidalun1020/bce-embedding-base_v1", **kwargs):
         if not settings.LIGHTEN and not YoudaoEmbed._client:
@@ -356,7 +363,7 @@ class YoudaoEmbed(Base):
                         "maidalun1020", "InfiniFlow"))
 
     def encode(self, texts: list):
-        batch_size = 10
+        batch_size = self.max_batch_size
         res = []
         token_count = 0
         for t in texts:
@@ -254,8 +254,21 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
+def tokenize_many(ds, ts, eng):
+    """
+    tokenize() for all the chunks of a document in one tokenizer call.
+    """
+    for d, t in zip(ds, ts):
+        d["content_with_weight"] = t
+    ts = [re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t) for t in ts]
+    for d, ltks in zip(ds, rag_tokenizer.tokenize_many(ts)):
+        d["content_ltks"] = ltks
+        d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(ltks)
+
+
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
     res = []
+    cks = []
     # wrap up as es documents
     for ck in chunks:
         if len(ck.strip()) == 0:
@@ -269,13 +282,15 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 ck = pdf_parser.remove_tag(ck)
             except NotImplementedError:
                 pass
-        tokenize(d, ck, eng)
+        cks.append(ck)
         res.append(d)
+    tokenize_many(res, cks, eng)
     return res
 
 
 def tokenize_chunks_docx(chunks, doc, eng, images):
     res = []
+    cks = []
     # wrap up as es documents
     for ck, image in zip(chunks, images):
         if len(ck.strip()) == 0:
@@ -283,8 +298,9 @@ def tokenize_chunks_docx(chunks, doc, eng, images):
         logging.debug("-- {}".format(ck))
         d = copy.deepcopy(doc)
         d["image"] = image
-        tokenize(d, ck, eng)
+        cks.append(ck)
         res.append(d)
+    tokenize_many(res, cks, eng)
     return res
 
 
@@ -17,6 +17,7 @@
 import logging
 import json
 import re
+import numpy as np
 from rag.utils.doc_store_conn import MatchTextExpr
 
 from rag.nlp import rag_tokenizer, term_weight, synonym
@@ -201,29 +202,48 @@ class FulltextQueryer:
         return None, keywords
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3, vtweight=0.7):
-        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-
-        sims = CosineSimilarity([avec], bvecs)
+        avec = np.asarray(avec, dtype=np.float64)
+        bvecs = np.asarray(bvecs, dtype=np.float64)
+        norms = np.linalg.norm(bvecs, axis=1) * np.linalg.norm(avec)
+        norms[norms == 0] = 1
+        sims = bvecs @ avec / norms
         tksim = self.token_similarity(atks, btkss)
-        if np.sum(sims[0]) == 0:
-            return np.array(tksim), tksim, sims[0]
-        return np.array(sims[0]) * vtweight + np.array(tksim) * tkweight, tksim, sims[0]
+        if np.sum(sims) == 0:
+            return np.array(tksim), tksim, sims
+        return sims * vtweight + np.array(tksim) * tkweight, tksim, sims
+
+    def term_weights(self, tks):
+        """
+        Normalized term weight vector of a token list, as a dict.
+        """
+        twt = {}
+        for t, c in self.tw.weights(tks, preprocess=False):
+            twt[t] = twt.get(t, 0) + c
+        return twt
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            d = {}
-            if isinstance(tks, str):
-                tks = tks.split()
-            for t, c in self.tw.weights(tks, preprocess=False):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
+        """
+        Fraction of the query term weight found in every candidate, in one pass.
+        Only the presence of query terms in a candidate counts, so candidates are reduced to term sets
+        and no term weighting is run on them. `btkss` items may be token strings, lists or sets.
+        """
+        if isinstance(atks, str):
+            atks = atks.split()
+        qtwt = self.term_weights(atks)
+        col = {t: i for i, t in enumerate(qtwt.keys())}
+        qw = np.array(list(qtwt.values()), dtype=np.float64)
 
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+        rows, cols = [], []
+        for i, btks in enumerate(btkss):
+            if isinstance(btks, str):
+                btks = btks.split()
+            for t in set(btks):
+                if t in col:
+                    rows.append(i)
+                    cols.append(col[t])
+        hits = np.zeros((len(btkss), len(col)), dtype=np.float64)
+        hits[rows, cols] = 1
+        return ((hits @ qw + 1e-9) / (np.sum(qw) + 1e-9)).tolist()
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
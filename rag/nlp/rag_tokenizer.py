@@ -15,17 +15,25 @@
 #
 
 import logging
-import copy
 import datrie
 import math
 import os
 import re
 import string
 import sys
+import threading
+from functools import lru_cache
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
+from api.utils.log_utils import log_startup_time
+
+# Number of distinct lines whose tokens are cached, and the longest line that is cached.
+TOKENIZE_CACHE_SIZE = int(os.environ.get("TOKENIZE_CACHE_SIZE", "50000"))
+TOKENIZE_CACHE_MAX_LEN = int(os.environ.get("TOKENIZE_CACHE_MAX_LEN", "1024"))
+# Number of trie lookups cached.
+TRIE_LOOKUP_CACHE_SIZE = int(os.environ.get("TRIE_LOOKUP_CACHE_SIZE", "1000000"))
 
 
 class RagTokenizer:
@@ -36,6 +44,10 @@ class RagTokenizer:
         return str(("DD" + (line[::-1].lower())).encode("utf-8"))[2:-1]
 
     def loadDict_(self, fnm):
+        self._buildTrie_(self.trie_, fnm)
+        self._clear_caches()
+
+    def _buildTrie_(self, trie, fnm):
         logging.info(f"[HUQIE]:Build trie from {fnm}")
         try:
             of = open(fnm, "r", encoding='utf-8')
@@ -47,17 +59,50 @@ class RagTokenizer:
                 line = re.split(r"[ \t]", line)
                 k = self.key_(line[0])
                 F = int(math.log(float(line[1]) / self.DENOMINATOR) + .5)
-                if k not in self.trie_ or self.trie_[k][0] < F:
-                    self.trie_[self.key_(line[0])] = (F, line[2])
-                self.trie_[self.rkey_(line[0])] = 1
+                if k not in trie or trie[k][0] < F:
+                    trie[self.key_(line[0])] = (F, line[2])
+                trie[self.rkey_(line[0])] = 1
 
             dict_file_cache = fnm + ".trie"
             logging.info(f"[HUQIE]:Build trie cache to {dict_file_cache}")
-            self.trie_.save(dict_file_cache)
+            # other processes of the host may be loading the cache, it's replaced once complete
+            tmp_file = f"{dict_file_cache}.{os.getpid()}.tmp"
+            trie.save(tmp_file)
+            os.replace(tmp_file, dict_file_cache)
             of.close()
         except Exception:
             logging.exception(f"[HUQIE]:Build trie {fnm} failed")
 
+    def _clear_caches(self):
+        self._lookups = {}
+        self._rlookups = {}
+        self._tokenize_cached.cache_clear()
+
+    def _lookup(self, t):
+        """
+        (trie value or None, whether some word starts with t), with the key encoded once per string.
+        """
+        r = self._lookups.get(t)
+        if r is None:
+            k, trie = self.key_(t), self.trie_
+            if k in trie:
+                r = (trie[k], True)
+            else:
+                r = (None, trie.has_keys_with_prefix(k))
+            if len(self._lookups) >= TRIE_LOOKUP_CACHE_SIZE:
+                self._lookups = {}
+            self._lookups[t] = r
+        return r
+
+    def _has_rprefix(self, t):
+        r = self._rlookups.get(t)
+        if r is None:
+            r = self.trie_.has_keys_with_prefix(self.rkey_(t))
+            if len(self._rlookups) >= TRIE_LOOKUP_CACHE_SIZE:
+                self._rlookups = {}
+            self._rlookups[t] = r
+        return r
+
     def __init__(self, debug=False):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
@@ -68,28 +113,50 @@ class RagTokenizer:
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
+        self._lookups = {}
+        self._rlookups = {}
+        self._tokenize_cached = lru_cache(maxsize=TOKENIZE_CACHE_SIZE)(self._tokenize)
+
+        # the trie is loaded on first use, processes that never tokenize don't pay for it
+        self._trie = None
+        self._trie_lock = threading.Lock()
+
+    @property
+    def trie_(self):
+        if self._trie is None:
+            with self._trie_lock:
+                if self._trie is None:
+                    with log_startup_time("huqie trie"):
+                        self._trie = self._loadTrie_()
+        return self._trie
+
+    @trie_.setter
+    def trie_(self, trie):
+        self._trie = trie
+
+    def _loadTrie_(self):
         trie_file_name = self.DIR_ + ".txt.trie"
         # check if trie file existence
         if os.path.exists(trie_file_name):
             try:
                 # load trie from file
-                self.trie_ = datrie.Trie.load(trie_file_name)
-                return
+                return datrie.Trie.load(trie_file_name)
             except Exception:
                 # fail to load trie from file, build default trie
                 logging.exception(f"[HUQIE]:Fail to load trie file {trie_file_name}, build the default trie file")
-                self.trie_ = datrie.Trie(string.printable)
         else:
             # file not exist, build default trie
             logging.info(f"[HUQIE]:Trie file {trie_file_name} not found, build the default trie file")
-            self.trie_ = datrie.Trie(string.printable)
 
         # load data from dict file and save to trie file
-        self.loadDict_(self.DIR_ + ".txt")
+        trie = datrie.Trie(string.printable)
+        self._buildTrie_(trie, self.DIR_ + ".txt")
+        return trie
 
     def loadUserDict(self, fnm):
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
+            self._clear_caches()
             return
         except Exception:
             self.trie_ = datrie.Trie(string.printable)
@@ -117,64 +184,71 @@ class RagTokenizer:
         return HanziConv.toSimplified(line)
 
     def dfs_(self, chars, s, preTks, tkslist):
-        res = s
-        # if s > MAX_L or s>= len(chars):
+        """
+        Append every segmentation of chars[s:] to tkslist, each prefixed with preTks, the tokens of chars[:s].
+        Segmentations of a suffix are enumerated once and shared by all the prefixes leading to it.
+        """
+        chars = "".join(chars)
+        singles = 0
+        for tk, _ in preTks[::-1][:3]:
+            if len(tk) != 1:
+                break
+            singles += 1
+        res, paths = self._dfs_paths(chars, s, singles, {})
+        for p in paths:
+            tkslist.append(preTks + list(p))
+        return res
+
+    def _dfs_paths(self, chars, s, singles, memo):
+        # `singles` is the number of one-char tokens right before s, capped at 3
+        if (s, singles) in memo:
+            return memo[(s, singles)]
         if s >= len(chars):
-            tkslist.append(preTks)
-            return res
+            return s, [()]
 
         # pruning
         S = s + 1
         if s + 2 <= len(chars):
-            t1, t2 = "".join(chars[s:s + 1]), "".join(chars[s:s + 2])
-            if self.trie_.has_keys_with_prefix(self.key_(t1)) and not self.trie_.has_keys_with_prefix(
-                    self.key_(t2)):
-                S = s + 2
-        if len(preTks) > 2 and len(
-                preTks[-1][0]) == 1 and len(preTks[-2][0]) == 1 and len(preTks[-3][0]) == 1:
-            t1 = preTks[-1][0] + "".join(chars[s:s + 1])
-            if self.trie_.has_keys_with_prefix(self.key_(t1)):
+            if self._lookup(chars[s:s + 1])[1] and not self._lookup(chars[s:s + 2])[1]:
                 S = s + 2
+        if singles >= 3 and self._lookup(chars[s - 1:s + 1])[1]:
+            S = s + 2
 
         ################
+        res, paths = s, []
         for e in range(S, len(chars) + 1):
-            t = "".join(chars[s:e])
-            k = self.key_(t)
-
-            if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
+            t = chars[s:e]
+            v, has_prefix = self._lookup(t)
+            if e > s + 1 and not has_prefix:
                 break
 
-            if k in self.trie_:
-                pretks = copy.deepcopy(preTks)
-                if k in self.trie_:
-                    pretks.append((t, self.trie_[k]))
-                else:
-                    pretks.append((t, (-12, '')))
-                res = max(res, self.dfs_(chars, e, pretks, tkslist))
-
-        if res > s:
-            return res
+            if v is not None:
+                r, sub = self._dfs_paths(chars, e, min(singles + 1, 3) if e == s + 1 else 0, memo)
+                res = max(res, r)
+                tk = (t, v)
+                paths.extend([(tk,) + p for p in sub])
 
-        t = "".join(chars[s:s + 1])
-        k = self.key_(t)
-        if k in self.trie_:
-            preTks.append((t, self.trie_[k]))
-        else:
-            preTks.append((t, (-12, '')))
+        if res <= s:
+            t = chars[s:s + 1]
+            v, _ = self._lookup(t)
+            tk = (t, v if v is not None else (-12, ''))
+            res, sub = self._dfs_paths(chars, s + 1, min(singles + 1, 3), memo)
+            paths = [(tk,) + p for p in sub]
 
-        return self.dfs_(chars, s + 1, preTks, tkslist)
+        memo[(s, singles)] = (res, paths)
+        return res, paths
 
     def freq(self, tk):
-        k = self.key_(tk)
-        if k not in self.trie_:
+        v, _ = self._lookup(tk)
+        if v is None:
             return 0
-        return int(math.exp(self.trie_[k][0]) * self.DENOMINATOR + 0.5)
+        return int(math.exp(v[0]) * self.DENOMINATOR + 0.5)
 
     def tag(self, tk):
-        k = self.key_(tk)
-        if k not in self.trie_:
+        v, _ = self._lookup(tk)
+        if v is None:
             return ""
-        return self.trie_[k][1]
+        return v[1]
 
     def score_(self, tfts):
         B = 30
@@ -219,19 +293,16 @@ class RagTokenizer:
         while s < len(line):
             e = s + 1
             t = line[s:e]
-            while e < len(line) and self.trie_.has_keys_with_prefix(
-                    self.key_(t)):
+            while e < len(line) and self._lookup(t)[1]:
                 e += 1
                 t = line[s:e]
 
-            while e - 1 > s and self.key_(t) not in self.trie_:
+            while e - 1 > s and self._lookup(t)[0] is None:
                 e -= 1
                 t = line[s:e]
 
-            if self.key_(t) in self.trie_:
-                res.append((t, self.trie_[self.key_(t)]))
-            else:
-                res.append((t, (0, '')))
+            v, _ = self._lookup(t)
+            res.append((t, v if v is not None else (0, '')))
 
             s = e
 
@@ -243,18 +314,16 @@ class RagTokenizer:
         while s >= 0:
             e = s + 1
             t = line[s:e]
-            while s > 0 and self.trie_.has_keys_with_prefix(self.rkey_(t)):
+            while s > 0 and self._has_rprefix(t):
                 s -= 1
                 t = line[s:e]
 
-            while s + 1 < e and self.key_(t) not in self.trie_:
+            while s + 1 < e and self._lookup(t)[0] is None:
                 s += 1
                 t = line[s:e]
 
-            if self.key_(t) in self.trie_:
-                res.append((t, self.trie_[self.key_(t)]))
-            else:
-                res.append((t, (0, '')))
+            v, _ = self._lookup(t)
+            res.append((t, v if v is not None else (0, '')))
 
             s -= 1
 
@@ -287,6 +356,21 @@ class RagTokenizer:
         return txt_lang_pairs
 
     def tokenize(self, line):
+        if len(line) <= TOKENIZE_CACHE_MAX_LEN:
+            return self._tokenize_cached(line)
+        return self._tokenize(line)
+
+    def tokenize_many(self, lines):
+        """
+        Tokenize a batch of lines, e.g. all the chunks of a document. Repeated lines are tokenized once.
+        """
+        done = {}
+        for line in lines:
+            if line not in done:
+                done[line] = self.tokenize(line)
+        return [done[line] for line in lines]
+
+    def _tokenize(self, line):
         line = re.sub(r"\W+", " ", line)
         line = self._strQ2B(line).lower()
         line = self._tradi2simp(line)
@@ -433,6 +517,7 @@ def naiveQie(txt):
 
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
+tokenize_many = tokenizer.tokenize_many
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
 tag = tokenizer.tag
 freq = tokenizer.freq
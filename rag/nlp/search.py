@@ -13,11 +13,15 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import ast
+import json
 import logging
+import os
 import re
 from dataclasses import dataclass
+from functools import lru_cache
 
-from rag.settings import TAG_FLD, PAGERANK_FLD
+from rag.settings import TAG_FLD, PAGERANK_FLD, TERM_WEIGHT_FLD
 from rag.utils import rmSpace
 from rag.nlp import rag_tokenizer, query
 import numpy as np
@@ -27,6 +31,45 @@ from rag.utils.doc_store_conn import DocStoreConnection, MatchDenseExpr, FusionE
 def index_name(uid): return f"ragflow_{uid}"
 
 
+@lru_cache(maxsize=int(os.environ.get("TAG_FEAS_CACHE_SIZE", "65536")))
+def _decode_tag_feas_str(txt: str):
+    try:
+        feas = json.loads(txt)
+    except ValueError:
+        # dict literals written by older versions
+        try:
+            feas = ast.literal_eval(txt)
+        except (ValueError, SyntaxError):
+            logging.warning(f"Invalid {TAG_FLD}: {txt[:64]}")
+            return (), np.zeros(0)
+    if not isinstance(feas, dict):
+        return (), np.zeros(0)
+    return _decode_tag_feas_dict(feas)
+
+
+def _decode_tag_feas_dict(feas: dict):
+    tags, scores = [], []
+    for t, sc in feas.items():
+        try:
+            scores.append(float(sc))
+            tags.append(t)
+        except (TypeError, ValueError):
+            continue
+    return tuple(tags), np.array(scores, dtype=float)
+
+
+def decode_tag_feas(feas):
+    """
+    Tag features of a chunk as (tags, scores). The doc store hands them over as a dict or as a JSON string,
+    decoded strings are cached since the same chunks come back across queries.
+    """
+    if not feas:
+        return (), np.zeros(0)
+    if isinstance(feas, dict):
+        return _decode_tag_feas_dict(feas)
+    return _decode_tag_feas_str(str(feas))
+
+
 class Dealer:
     def __init__(self, dataStore: DocStoreConnection):
         self.qryr = query.FulltextQueryer()
@@ -77,12 +120,13 @@ class Dealer:
         topk = int(req.get("topk", 1024))
         ps = int(req.get("size", topk))
         offset, limit = pg * ps, ps
+        track_total_hits = req.get("track_total_hits", True)
 
         src = req.get("fields",
                       ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd", "position_int",
                        "doc_id", "page_num_int", "top_int", "create_timestamp_flt", "knowledge_graph_kwd",
                        "question_kwd", "question_tks",
-                       "available_int", "content_with_weight", PAGERANK_FLD, TAG_FLD])
+                       "available_int", "content_with_weight", PAGERANK_FLD, TAG_FLD, TERM_WEIGHT_FLD])
         kwds = set([])
 
         qst = req.get("question", "")
@@ -92,7 +136,8 @@ class Dealer:
                 orderBy.asc("page_num_int")
                 orderBy.asc("top_int")
                 orderBy.desc("create_timestamp_flt")
-            res = self.dataStore.search(src, [], filters, [], orderBy, offset, limit, idx_names, kb_ids)
+            res = self.dataStore.search(src, [], filters, [], orderBy, offset, limit, idx_names, kb_ids,
+                                        track_total_hits=track_total_hits)
             total = self.dataStore.getTotal(res)
             logging.debug("Dealer.search TOTAL: {}".format(total))
         else:
@@ -101,7 +146,8 @@ class Dealer:
             if emb_mdl is None:
                 matchExprs = [matchText]
                 res = self.dataStore.search(src, highlightFields, filters, matchExprs, orderBy, offset, limit,
-                                            idx_names, kb_ids, rank_feature=rank_feature)
+                                            idx_names, kb_ids, rank_feature=rank_feature,
+                                            track_total_hits=track_total_hits)
                 total = self.dataStore.getTotal(res)
                 logging.debug("Dealer.search TOTAL: {}".format(total))
             else:
@@ -113,7 +159,8 @@ class Dealer:
                 matchExprs = [matchText, matchDense, fusionExpr]
 
                 res = self.dataStore.search(src, highlightFields, filters, matchExprs, orderBy, offset, limit,
-                                            idx_names, kb_ids, rank_feature=rank_feature)
+                                            idx_names, kb_ids, rank_feature=rank_feature,
+                                            track_total_hits=track_total_hits)
                 total = self.dataStore.getTotal(res)
                 logging.debug("Dealer.search TOTAL: {}".format(total))
 
@@ -123,7 +170,8 @@ class Dealer:
                     filters.pop("doc_ids", None)
                     matchDense.extra_options["similarity"] = 0.17
                     res = self.dataStore.search(src, highlightFields, filters, [matchText, matchDense, fusionExpr],
-                                                orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature)
+                                                orderBy, offset, limit, idx_names, kb_ids, rank_feature=rank_feature,
+                                                track_total_hits=track_total_hits)
                     total = self.dataStore.getTotal(res)
                     logging.debug("Dealer.search 2 TOTAL: {}".format(total))
 
@@ -206,7 +254,7 @@ class Dealer:
         assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
             len(ans_v[0]), len(chunk_v[0]))
 
-        chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split()
+        chunks_tks = [set(rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split())
                       for ck in chunks]
         cites = {}
         thr = 0.63
@@ -246,27 +294,60 @@ class Dealer:
 
     def _rank_feature_scores(self, query_rfea, search_res):
         ## For rank feature(tag_fea) scores.
-        rank_fea = []
         pageranks = []
         for chunk_id in search_res.ids:
             pageranks.append(search_res.field[chunk_id].get(PAGERANK_FLD, 0))
         pageranks = np.array(pageranks, dtype=float)
 
         if not query_rfea:
-            return np.array([0 for _ in range(len(search_res.ids))]) + pageranks
+            return np.zeros(len(search_res.ids)) + pageranks
 
         q_denor = np.sqrt(np.sum([s*s for t,s in query_rfea.items() if t != PAGERANK_FLD]))
-        for i in search_res.ids:
-            nor, denor = 0, 0
-            for t, sc in eval(search_res.field[i].get(TAG_FLD, "{}")).items():
-                if t in query_rfea:
-                    nor += query_rfea[t] * sc
-                denor += sc * sc
-            if denor == 0:
-                rank_fea.append(0)
-            else:
-                rank_fea.append(nor/np.sqrt(denor)/q_denor)
-        return np.array(rank_fea)*10. + pageranks
+        if q_denor == 0:
+            return np.zeros(len(search_res.ids)) + pageranks
+        col = {t: j for j, t in enumerate(query_rfea.keys())}
+        qv = np.array(list(query_rfea.values()), dtype=float)
+        # chunk x query tag matrix, the norms of chunks take all of their tags
+        tag_mtx = np.zeros((len(search_res.ids), len(col)))
+        denor = np.zeros(len(search_res.ids))
+        for i, chunk_id in enumerate(search_res.ids):
+            tags, scores = decode_tag_feas(search_res.field[chunk_id].get(TAG_FLD))
+            if not tags:
+                continue
+            denor[i] = np.sum(np.square(scores))
+            for t, sc in zip(tags, scores):
+                if t in col:
+                    tag_mtx[i, col[t]] = sc
+        nor = tag_mtx @ qv
+        rank_fea = np.divide(nor, np.sqrt(denor) * q_denor, out=np.zeros_like(nor), where=denor > 0)
+        return rank_fea*10. + pageranks
+
+    @staticmethod
+    def chunk_terms(chunk, cfield="content_ltks"):
+        if isinstance(chunk.get("important_kwd", []), str):
+            chunk["important_kwd"] = [chunk["important_kwd"]]
+        content_ltks = chunk.get(cfield, "").split()
+        title_tks = [t for t in chunk.get("title_tks", "").split() if t]
+        question_tks = [t for t in chunk.get("question_tks", "").split() if t]
+        important_kwd = chunk.get("important_kwd", [])
+        return content_ltks + title_tks * 2 + important_kwd * 5 + question_tks * 6
+
+    def term_weight_field(self, chunk):
+        """
+        The chunk's normalized term weight vector stored at index time, so that reranking needs no tokenization.
+        """
+        twt = self.qryr.term_weights(self.chunk_terms(chunk))
+        return json.dumps({t: round(float(w), 6) for t, w in twt.items()}, ensure_ascii=False)
+
+    @staticmethod
+    def stored_term_weights(chunk):
+        twt = chunk.get(TERM_WEIGHT_FLD)
+        if not twt:
+            return None
+        try:
+            return json.loads(twt) if isinstance(twt, str) else twt
+        except Exception:
+            return None
 
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks",
@@ -285,17 +366,10 @@ class Dealer:
         if not ins_embd:
             return [], [], []
 
-        for i in sres.ids:
-            if isinstance(sres.field[i].get("important_kwd", []), str):
-                sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
         ins_tw = []
         for i in sres.ids:
-            content_ltks = sres.field[i][cfield].split()
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split() if t]
-            question_tks = [t for t in sres.field[i].get("question_tks", "").split() if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks * 2 + important_kwd * 5 + question_tks * 6
-            ins_tw.append(tks)
+            twt = self.stored_term_weights(sres.field[i]) if cfield == "content_ltks" else None
+            ins_tw.append(twt.keys() if twt else self.chunk_terms(sres.field[i], cfield))
 
         ## For rank feature(tag_fea) scores.
         rank_fea = self._rank_feature_scores(rank_feature, sres)
@@ -437,7 +511,7 @@ class Dealer:
         bs = 128
         for p in range(offset, max_count, bs):
             es_res = self.dataStore.search(fields, [], condition, [], OrderByExpr(), p, bs, index_name(tenant_id),
-                                           kb_ids)
+                                           kb_ids, track_total_hits=False)
             dict_chunks = self.dataStore.getFields(es_res, fields)
             for id, doc in dict_chunks.items():
                 doc["id"] = id
@@ -19,8 +19,10 @@ import json
 import os
 import time
 import re
+import threading
 from nltk.corpus import wordnet
 from api.utils.file_utils import get_project_base_directory
+from api.utils.log_utils import log_startup_time
 
 
 class Dealer:
@@ -28,23 +30,41 @@ class Dealer:
 
         self.lookup_num = 100000000
         self.load_tm = time.time() - 1000000
-        self.dictionary = None
-        path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
-        try:
-            self.dictionary = json.load(open(path, 'r'))
-        except Exception:
-            logging.warning("Missing synonym.json")
-            self.dictionary = {}
+        # synonym.json is loaded on first lookup
+        self._dictionary = None
+        self._dictionary_lock = threading.Lock()
 
         if not redis:
             logging.warning(
                 "Realtime synonym is disabled, since no redis connection.")
-        if not len(self.dictionary.keys()):
-            logging.warning("Fail to load synonym")
 
         self.redis = redis
         self.load()
 
+    @property
+    def dictionary(self):
+        if self._dictionary is None:
+            with self._dictionary_lock:
+                if self._dictionary is None:
+                    with log_startup_time("synonym dictionary"):
+                        self._dictionary = self._read_dictionary()
+        return self._dictionary
+
+    @dictionary.setter
+    def dictionary(self, dictionary):
+        self._dictionary = dictionary
+
+    def _read_dictionary(self):
+        path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
+        try:
+            dictionary = json.load(open(path, 'r'))
+        except Exception:
+            logging.warning("Missing synonym.json")
+            dictionary = {}
+        if not len(dictionary.keys()):
+            logging.warning("Fail to load synonym")
+        return dictionary
+
     def load(self):
         if not self.redis:
             return
@@ -19,9 +19,11 @@ import math
 import json
 import re
 import os
+import threading
 import numpy as np
 from rag.nlp import rag_tokenizer
 from api.utils.file_utils import get_project_base_directory
+from api.utils.log_utils import log_startup_time
 
 
 class Dealer:
@@ -57,7 +59,27 @@ class Dealer:
                                "哪些",
                                "啥",
                                "相关"])
+        # ner.json and term.freq are loaded on first use
+        self._dicts = None
+        self._dicts_lock = threading.Lock()
 
+    @property
+    def ne(self):
+        return self._load_dicts()[0]
+
+    @property
+    def df(self):
+        return self._load_dicts()[1]
+
+    def _load_dicts(self):
+        if self._dicts is None:
+            with self._dicts_lock:
+                if self._dicts is None:
+                    with log_startup_time("term weight dictionaries"):
+                        self._dicts = self._read_dicts()
+        return self._dicts
+
+    def _read_dicts(self):
         def load_dict(fnm):
             res = {}
             f = open(fnm, "r")
@@ -79,15 +101,16 @@ class Dealer:
             return res
 
         fnm = os.path.join(get_project_base_directory(), "rag/res")
-        self.ne, self.df = {}, {}
+        ne, df = {}, {}
         try:
-            self.ne = json.load(open(os.path.join(fnm, "ner.json"), "r"))
+            ne = json.load(open(os.path.join(fnm, "ner.json"), "r"))
         except Exception:
             logging.warning("Load ner.json FAIL!")
         try:
-            self.df = load_dict(os.path.join(fnm, "term.freq"))
+            df = load_dict(os.path.join(fnm, "term.freq"))
         except Exception:
             logging.warning("Load term.freq FAIL!")
+        return ne, df
 
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
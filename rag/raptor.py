@@ -13,16 +13,38 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
 import logging
+import os
 import re
 from threading import Lock
 import umap
 import numpy as np
 from sklearn.mixture import GaussianMixture
 import trio
+import xxhash
 
-from graphrag.utils import get_llm_cache, get_embed_cache, set_embed_cache, set_llm_cache, chat_limiter
+from graphrag.utils import get_llm_cache, set_llm_cache, chat_limiter
 from rag.utils import truncate
+from rag.utils.redis_conn import REDIS_CONN
+
+# Cluster counts tried per round of the search for the lowest BIC, every round narrows the range around the best one.
+RAPTOR_BIC_PROBES = int(os.environ.get("RAPTOR_BIC_PROBES", "4"))
+# Seconds a checkpoint of the finished layers is kept for a retried task.
+RAPTOR_CHECKPOINT_TTL = int(os.environ.get("RAPTOR_CHECKPOINT_TTL", str(24 * 3600)))
+
+
+def raptor_checkpoint_key(doc_id, raptor_config, chunks):
+    """
+    Checkpoints are only resumed by a run over the same chunks with the same settings: a re-parse may produce
+    as many chunks as a failed run but different ones.
+    """
+    hasher = xxhash.xxh64()
+    hasher.update((doc_id + json.dumps(raptor_config, sort_keys=True)).encode("utf-8"))
+    for cnt, _ in chunks:
+        hasher.update(b"\0")
+        hasher.update(str(cnt).encode("utf-8"))
+    return "raptor_ckpt:" + hasher.hexdigest()
 
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
@@ -45,34 +67,87 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         set_llm_cache(self._llm_model.llm_name, system, response, history, gen_conf)
         return response
 
-    def _embedding_encode(self, txt):
-        response = get_embed_cache(self._embd_model.llm_name, txt)
-        if response is not None:
-            return response
-        embds, _ = self._embd_model.encode([txt])
-        if len(embds) < 1 or len(embds[0]) < 1:
-            raise Exception("Embedding error: ")
-        embds = embds[0]
-        set_embed_cache(self._embd_model.llm_name, txt, embds)
+    def _embedding_encode_batch(self, txts):
+        # the embedding model looks the texts up in the embedding cache itself
+        bs = getattr(self._embd_model, "max_batch_size", 16)
+        embds = []
+        for i in range(0, len(txts), bs):
+            vts, _ = self._embd_model.encode(txts[i: i + bs])
+            if len(vts) != len(txts[i: i + bs]) or len(vts[0]) < 1:
+                raise Exception("Embedding error: ")
+            embds.extend(vts)
         return embds
 
     def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
+        """
+        Cluster count in [1, max_cluster) with the lowest BIC, and the mixture fitted for it.
+        Instead of fitting every count, each round tries RAPTOR_BIC_PROBES evenly spaced counts and narrows
+        the range to the neighbourhood of the best one, until neighbouring counts are tried.
+        """
         max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
-
-    async def __call__(self, chunks, random_state, callback=None):
+        fitted = {}
+
+        def bic(n):
+            if n not in fitted:
+                gm = GaussianMixture(n_components=n, random_state=random_state)
+                gm.fit(embeddings)
+                fitted[n] = (gm.bic(embeddings), gm)
+            return fitted[n][0]
+
+        lo, hi = 1, max(1, max_clusters - 1)
+        while True:
+            step = max(1, (hi - lo) // max(1, RAPTOR_BIC_PROBES))
+            best = min(sorted(set(list(range(lo, hi + 1, step)) + [hi])), key=bic)
+            if step == 1:
+                return best, fitted[best][1]
+            lo, hi = max(1, best - step + 1), min(max_clusters - 1, best + step - 1)
+
+    def _load_checkpoint(self, checkpoint_key, n_chunks):
+        if not checkpoint_key:
+            return None
+        try:
+            ckpt = REDIS_CONN.get(checkpoint_key)
+            if not ckpt:
+                return None
+            ckpt = json.loads(ckpt)
+            if ckpt["n_chunks"] != n_chunks:
+                return None
+            return ckpt
+        except Exception:
+            logging.exception("RAPTOR fails to load checkpoint")
+            return None
+
+    def _save_checkpoint(self, checkpoint_key, n_chunks, chunks, layers, labels, start, end):
+        if not checkpoint_key:
+            return
+        REDIS_CONN.set(checkpoint_key, json.dumps({
+            "n_chunks": n_chunks,
+            "summaries": [(cnt, [float(v) for v in embd]) for cnt, embd in chunks[n_chunks:]],
+            "layers": layers,
+            "labels": [int(lbl) for lbl in labels],
+            "start": start,
+            "end": end
+        }, ensure_ascii=False), RAPTOR_CHECKPOINT_TTL)
+
+    async def __call__(self, chunks, random_state, callback=None, checkpoint_key=None):
+        """
+        With `checkpoint_key`, the layers done so far are kept in Redis, so that a retried task resumes after them.
+        """
         layers = [(0, len(chunks))]
         start, end = 0, len(chunks)
         if len(chunks) <= 1:
             return []
         chunks = [(s, a) for s, a in chunks if s and len(a) > 0]
+        n_chunks = len(chunks)
+        labels = []
+        ckpt = self._load_checkpoint(checkpoint_key, n_chunks)
+        if ckpt:
+            chunks.extend([(cnt, np.array(embd)) for cnt, embd in ckpt["summaries"]])
+            layers = [tuple(lyr) for lyr in ckpt["layers"]]
+            labels = ckpt["labels"]
+            start, end = ckpt["start"], ckpt["end"]
+            if callback:
+                callback(msg="Resume from {} clustered layers.".format(len(layers) - 1))
 
         async def summarize(ck_idx, lock):
             nonlocal chunks
@@ -89,37 +164,42 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 cnt = re.sub("(······\n由于长度的原因，回答被截断了，要继续吗？|For the content length reason, it stopped, continue?)", "",
                              cnt)
                 logging.debug(f"SUM: {cnt}")
-                embds, _ = self._embd_model.encode([cnt])
                 with lock:
-                    chunks.append((cnt, self._embedding_encode(cnt)))
+                    # embedded with the rest of the layer
+                    chunks.append((cnt, None))
             except Exception as e:
                 logging.exception("summarize got exception")
                 return e
 
-        labels = []
+        async def embed_layer():
+            nonlocal chunks
+            txts = [cnt for cnt, _ in chunks[end:]]
+            embds = await trio.to_thread.run_sync(lambda: self._embedding_encode_batch(txts))
+            chunks[end:] = [(cnt, embd) for cnt, embd in zip(txts, embds)]
+
         lock = Lock()
         while end - start > 1:
             embeddings = [embd for _, embd in chunks[start: end]]
             if len(embeddings) == 2:
                 await summarize([start, start + 1], lock)
+                await embed_layer()
                 if callback:
                     callback(msg="Cluster one layer: {} -> {}".format(end - start, len(chunks) - end))
                 labels.extend([0, 0])
                 layers.append((end, len(chunks)))
                 start = end
                 end = len(chunks)
+                self._save_checkpoint(checkpoint_key, n_chunks, chunks, layers, labels, start, end)
                 continue
 
             n_neighbors = int((len(embeddings) - 1) ** 0.8)
             reduced_embeddings = umap.UMAP(
                 n_neighbors=max(2, n_neighbors), n_components=min(12, len(embeddings) - 2), metric="cosine"
             ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
+            n_clusters, gm = await trio.to_thread.run_sync(lambda: self._get_optimal_clusters(reduced_embeddings, random_state))
             if n_clusters == 1:
                 lbls = [0 for _ in range(len(reduced_embeddings))]
             else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
                 probs = gm.predict_proba(reduced_embeddings)
                 lbls = [np.where(prob > self._threshold)[0] for prob in probs]
                 lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
@@ -129,16 +209,20 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                     ck_idx = [i + start for i in range(len(lbls)) if lbls[i] == c]
                     if not ck_idx:
                         continue
-                    async with chat_limiter:
-                        nursery.start_soon(lambda: summarize(ck_idx, lock))
+                    nursery.start_soon(summarize, ck_idx, lock)
 
             assert len(chunks) - end == n_clusters, "{} vs. {}".format(len(chunks) - end, n_clusters)
+            await embed_layer()
             labels.extend(lbls)
             layers.append((end, len(chunks)))
             if callback:
                 callback(msg="Cluster one layer: {} -> {}".format(end - start, len(chunks) - end))
             start = end
             end = len(chunks)
+            self._save_checkpoint(checkpoint_key, n_chunks, chunks, layers, labels, start, end)
+
+        if checkpoint_key:
+            REDIS_CONN.delete(checkpoint_key)
 
         return chunks
 
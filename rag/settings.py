@@ -41,6 +41,7 @@ SVR_CONSUMER_NAME = "rag_flow_svr_consumer"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_consumer_group"
 PAGERANK_FLD = "pagerank_fea"
 TAG_FLD = "tag_feas"
+TERM_WEIGHT_FLD = "term_weight_with_weight"
 
 
 def print_rag_settings():
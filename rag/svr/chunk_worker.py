@@ -0,0 +1,138 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Process pool running the CPU-bound chunkers of rag/app outside the task executor,
+so that parsing is not serialized by the GIL of the executor process.
+"""
+import importlib
+import logging
+import multiprocessing
+import os
+import resource
+import threading
+from io import BytesIO
+
+import trio
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except Exception:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _compact(cks):
+    # PIL images are shipped back as JPEG bytes, build_chunks stores them as they are
+    for ck in cks:
+        img = ck.get("image")
+        if img is None or isinstance(img, bytes):
+            continue
+        buf = BytesIO()
+        img.save(buf, format="JPEG")
+        ck["image"] = buf.getvalue()
+    return cks
+
+
+def _worker_main(conn, max_rss_mb):
+    from api import settings
+    from api.utils.log_utils import initRootLogger
+    initRootLogger("chunk_worker_{}".format(os.getpid()))
+    settings.init_settings()
+    try:
+        # load OCR/layout/TSR models before the first task arrives
+        from deepdoc.parser import PdfParser
+        PdfParser()
+    except Exception:
+        logging.exception("chunk worker failed to preload deepdoc models")
+
+    # chunkers may report progress from several threads, frames written at once would corrupt the pipe
+    send_lock = threading.Lock()
+
+    def send(obj):
+        with send_lock:
+            conn.send(obj)
+
+    def callback(prog=None, msg="Processing..."):
+        send(("progress", (prog, msg)))
+
+    while True:
+        try:
+            req = conn.recv()
+        except EOFError:
+            return
+        module_name, kwargs = req
+        try:
+            cks = importlib.import_module(module_name).chunk(callback=callback, **kwargs)
+            send(("done", _compact(cks)))
+        except Exception as e:
+            logging.exception("chunk worker got exception")
+            send(("error", str(e)))
+        if max_rss_mb and _rss_mb() > max_rss_mb:
+            logging.info("chunk worker {} exits with RSS {:.0f}MB".format(os.getpid(), _rss_mb()))
+            send(("recycle", None))
+            return
+        send(("idle", None))
+
+
+class ChunkWorker:
+    def __init__(self, ctx, max_rss_mb):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, max_rss_mb), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ChunkWorkerPool:
+    """
+    Warm worker processes fed with (chunker module, chunk kwargs). Progress messages are relayed to
+    the task's callback. A worker is replaced once its RSS exceeds `max_rss_mb`, or when its task is canceled.
+    """
+
+    def __init__(self, size, max_rss_mb=0):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.max_rss_mb = max_rss_mb
+        self.send_idle, self.recv_idle = trio.open_memory_channel(size)
+        for _ in range(size):
+            self.send_idle.send_nowait(ChunkWorker(self.ctx, self.max_rss_mb))
+
+    async def chunk(self, module_name, kwargs, callback):
+        worker = await self.recv_idle.receive()
+        healthy = False
+        try:
+            await trio.to_thread.run_sync(lambda: worker.conn.send((module_name, kwargs)))
+            while True:
+                kind, payload = await trio.to_thread.run_sync(worker.conn.recv)
+                if kind == "progress":
+                    callback(*payload)
+                    continue
+                kind_after, _ = await trio.to_thread.run_sync(worker.conn.recv)
+                healthy = kind_after == "idle"
+                if kind == "error":
+                    raise Exception(payload)
+                return payload
+        finally:
+            if not healthy:
+                with trio.CancelScope(shield=True):
+                    await trio.to_thread.run_sync(worker.kill)
+                worker = ChunkWorker(self.ctx, self.max_rss_mb)
+            self.send_idle.send_nowait(worker)
@@ -19,7 +19,7 @@
 import random
 import sys
 
-from api.utils.log_utils import initRootLogger, get_project_base_directory
+from api.utils.log_utils import initRootLogger, get_project_base_directory, log_startup_time
 from graphrag.general.index import WithCommunity, WithResolution, Dealer
 from graphrag.light.graph_extractor import GraphExtractor as LightKGExt
 from graphrag.general.graph_extractor import GraphExtractor as GeneralKGExt
@@ -32,6 +32,7 @@ initRootLogger(CONSUMER_NAME)
 
 import logging
 import os
+import threading
 from datetime import datetime
 import json
 import xxhash
@@ -44,14 +45,15 @@ from timeit import default_timer as timer
 import tracemalloc
 import resource
 import signal
+from collections import OrderedDict, deque
 import trio
 
 import numpy as np
 from peewee import DoesNotExist
 
-from api.db import LLMType, ParserType, TaskStatus
+from api.db import LLMType, ParserType, TaskStatus, FileType
 from api.db.services.document_service import DocumentService
-from api.db.services.llm_service import LLMBundle
+from api.db.services.llm_service import LLMBundle, TenantLLMService
 from api.db.services.task_service import TaskService
 from api.db.services.file2document_service import File2DocumentService
 from api import settings
@@ -60,8 +62,10 @@ from api.db.db_models import close_connection
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio, \
     email, tag
 from rag.nlp import search, rag_tokenizer
-from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
-from rag.settings import DOC_MAXIMUM_SIZE, SVR_QUEUE_NAME, print_rag_settings, TAG_FLD, PAGERANK_FLD
+from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor, raptor_checkpoint_key
+from rag.svr.chunk_worker import ChunkWorkerPool
+from rag.settings import DOC_MAXIMUM_SIZE, SVR_QUEUE_NAME, print_rag_settings, TAG_FLD, PAGERANK_FLD, \
+    TERM_WEIGHT_FLD
 from rag.utils import num_tokens_from_string
 from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
@@ -100,8 +104,32 @@ CURRENT_TASKS = {}
 
 MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', "5"))
 MAX_CONCURRENT_CHUNK_BUILDERS = int(os.environ.get('MAX_CONCURRENT_CHUNK_BUILDERS', "1"))
+# Run chunkers in this many worker processes instead of threads, 0 keeps them in threads.
+CHUNK_WORKER_PROCESSES = int(os.environ.get('CHUNK_WORKER_PROCESSES', "0"))
+CHUNK_WORKER_MAX_RSS_MB = int(os.environ.get('CHUNK_WORKER_MAX_RSS_MB', "4096"))
+MAX_CONCURRENT_DOC_BULKS = int(os.environ.get('MAX_CONCURRENT_DOC_BULKS', "4"))
+DOC_BULK_SIZE = int(os.environ.get('DOC_BULK_SIZE', "64"))
+DOC_BULK_MAX_BYTES = int(os.environ.get('DOC_BULK_MAX_BYTES', str(16 * 1024 * 1024)))
+DOC_BULK_TARGET_LATENCY = float(os.environ.get('DOC_BULK_TARGET_LATENCY', "2.0"))
+CHUNK_IDS_CHECKPOINT = int(os.environ.get('CHUNK_IDS_CHECKPOINT', "2048"))
+EMBEDDING_WINDOW_SIZE = int(os.environ.get('EMBEDDING_WINDOW_SIZE', "256"))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', "2"))
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', "0"))
+DOC_STORE_NUMPY_VECTORS = int(os.environ.get('DOC_STORE_NUMPY_VECTORS', "0"))
+# Seconds progress messages of a task are buffered before being written, failures and completion are written at once.
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get('PROGRESS_FLUSH_INTERVAL', "2"))
+# Seconds between cancellation checks in the database, the cancel flag in Redis is checked on every progress update.
+PROGRESS_CANCEL_CHECK_INTERVAL = float(os.environ.get('PROGRESS_CANCEL_CHECK_INTERVAL', "10"))
+# Local directory where the executors of a host share the PDFs they fetch, so that the other page range tasks of
+# the document don't fetch it again. Empty, the default, disables it.
+STORAGE_CACHE_DIR = os.environ.get('STORAGE_CACHE_DIR', "")
+STORAGE_CACHE_TTL = int(os.environ.get('STORAGE_CACHE_TTL', "3600"))
+# The oldest files are removed once the directory grows beyond this size.
+STORAGE_CACHE_MAX_MB = int(os.environ.get('STORAGE_CACHE_MAX_MB', "2048"))
 task_limiter = trio.CapacityLimiter(MAX_CONCURRENT_TASKS)
-chunk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
+chunk_limiter = trio.CapacityLimiter(CHUNK_WORKER_PROCESSES or MAX_CONCURRENT_CHUNK_BUILDERS)
+CHUNK_WORKER_POOL = None
+doc_bulk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_DOC_BULKS)
 
 # SIGUSR1 handler: start tracemalloc and take snapshot
 def start_tracemalloc_and_snapshot(signum, frame):
@@ -129,15 +157,177 @@ def stop_tracemalloc(signum, frame):
     else:
         logging.info("tracemalloc not running")
 
+
+def flush_usage_and_terminate(signum, frame):
+    # write the buffered token usage, then terminate as SIGTERM would
+    try:
+        TenantLLMService.flush_usage()
+    except Exception:
+        logging.exception("flush token usage got exception")
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+class DocBulkSizer:
+    """
+    Sizes doc store bulk requests by chunk count and estimated payload bytes.
+    The chunk count adapts to the latency of the latest bulks so that the executor
+    backs off when Elasticsearch/Infinity is under pressure and grows again when it is not.
+    """
+
+    def __init__(self, size, max_bytes, target_latency, min_size=4, max_size=1024):
+        self.size = max(min_size, min(size, max_size))
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.latencies = deque(maxlen=64)
+
+    @staticmethod
+    def estimate_bytes(d):
+        n = 0
+        for k, v in d.items():
+            if isinstance(v, str):
+                n += len(k) + len(v)
+            elif isinstance(v, (list, np.ndarray)):
+                # dense vectors dominate the payload, a float takes roughly 20 bytes in JSON
+                n += len(k) + 20 * len(v)
+            else:
+                n += len(k) + 16
+        return n
+
+    def batches(self, chunks):
+        b = 0
+        while b < len(chunks):
+            e, nbytes = b, 0
+            while e < len(chunks) and e - b < self.size:
+                nbytes += self.estimate_bytes(chunks[e])
+                if e > b and nbytes > self.max_bytes:
+                    break
+                e += 1
+            yield chunks[b:e]
+            b = e
+
+    def record(self, count, elapsed, failed=False):
+        self.latencies.append(elapsed)
+        if failed or elapsed > 2 * self.target_latency:
+            self.size = max(self.min_size, self.size // 2)
+        elif elapsed < self.target_latency / 2 and count >= self.size:
+            self.size = min(self.max_size, self.size + max(1, self.size // 2))
+
+    def stats(self):
+        if not self.latencies:
+            return "bulk_size: {}".format(self.size)
+        lat = sorted(self.latencies)
+        return "bulk_size: {}, latency avg: {:.2f}s, p90: {:.2f}s".format(
+            self.size, sum(lat) / len(lat), lat[int(0.9 * (len(lat) - 1))])
+
+
+DOC_BULK_SIZER = DocBulkSizer(DOC_BULK_SIZE, DOC_BULK_MAX_BYTES, DOC_BULK_TARGET_LATENCY)
+
+
 class TaskCanceledException(Exception):
     def __init__(self, msg):
         self.msg = msg
 
 
+class TaskProgress:
+    """
+    Progress of one task: messages are buffered and written together with the latest progress.
+    Once the task is done or failed, a late progress from another thread can't take that back, only a failure can.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.doc_id = None
+        self.lock = threading.Lock()
+        # held from taking the buffer until it is written, so that writes land in the order they were buffered
+        self.flush_lock = threading.Lock()
+        self.msgs = []
+        self.prog = None
+        self.ended = False
+        # set once the task is over and the entry is no longer flushed by its end
+        self.closed = False
+        self.flushed_at = timer()
+        self.checked_at = timer()
+        self.canceled = False
+
+    def is_canceled(self):
+        if self.canceled:
+            return True
+        if self.doc_id is None:
+            self.doc_id = TaskService.get_by_id(self.task_id)[1].doc_id
+        if TaskService.has_cancel_flag(self.doc_id):
+            self.canceled = True
+        elif timer() - self.checked_at >= PROGRESS_CANCEL_CHECK_INTERVAL:
+            self.checked_at = timer()
+            self.canceled = TaskService.do_cancel(self.task_id)
+        return self.canceled
+
+    def add(self, msg, prog):
+        with self.lock:
+            if msg:
+                self.msgs.append(msg)
+            if prog is not None and (not self.ended or prog < 0):
+                self.prog = prog
+                self.ended = self.ended or prog < 0 or prog >= 1
+            return timer() - self.flushed_at >= PROGRESS_FLUSH_INTERVAL
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                msgs, prog = self.msgs, self.prog
+                self.msgs, self.prog = [], None
+                self.flushed_at = timer()
+            if not msgs and prog is None:
+                return
+            TaskService.append_progress(self.task_id, "\n".join(msgs), prog)
+        if self.doc_id is None:
+            self.doc_id = TaskService.get_by_id(self.task_id)[1].doc_id
+        DocumentService.publish_progress_event(self.doc_id)
+
+
+TASK_PROGRESS = {}
+# Ids of the latest tasks that are over, so that a thread of theirs still reporting can't leave an entry behind.
+ENDED_TASK_PROGRESS = OrderedDict()
+ENDED_TASK_PROGRESS_MAX = 1024
+TASK_PROGRESS_LOCK = threading.Lock()
+
+
+def get_task_progress(task_id):
+    with TASK_PROGRESS_LOCK:
+        if task_id not in TASK_PROGRESS:
+            task_progress = TaskProgress(task_id)
+            # late messages of an ended task are still written, but its progress stays where it ended
+            task_progress.closed = task_progress.ended = task_id in ENDED_TASK_PROGRESS
+            TASK_PROGRESS[task_id] = task_progress
+        return TASK_PROGRESS[task_id]
+
+
+def start_progress(task_id):
+    # the task is handled again, e.g. redelivered after a restart
+    with TASK_PROGRESS_LOCK:
+        ENDED_TASK_PROGRESS.pop(task_id, None)
+
+
+def flush_progress(task_id):
+    with TASK_PROGRESS_LOCK:
+        task_progress = TASK_PROGRESS.pop(task_id, None)
+        ENDED_TASK_PROGRESS[task_id] = True
+        ENDED_TASK_PROGRESS.move_to_end(task_id)
+        while len(ENDED_TASK_PROGRESS) > ENDED_TASK_PROGRESS_MAX:
+            ENDED_TASK_PROGRESS.popitem(last=False)
+    if task_progress:
+        with task_progress.lock:
+            task_progress.closed = task_progress.ended = True
+        task_progress.flush()
+        close_connection()
+
+
 def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing..."):
     if prog is not None and prog < 0:
         msg = "[ERROR]" + msg
-    cancel = TaskService.do_cancel(task_id)
+    task_progress = get_task_progress(task_id)
+    cancel = task_progress.is_canceled()
 
     if cancel:
         msg += " [Canceled]"
@@ -154,7 +344,14 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
         d["progress"] = prog
 
     logging.info(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}")
-    TaskService.update_progress(task_id, d)
+    due = task_progress.add(d["progress_msg"], d.get("progress"))
+    if due or cancel or task_progress.closed or (prog is not None and (prog < 0 or prog >= 1)):
+        task_progress.flush()
+    if task_progress.closed:
+        # nothing flushes the entry of an ended task later
+        with TASK_PROGRESS_LOCK:
+            if TASK_PROGRESS.get(task_id) is task_progress:
+                del TASK_PROGRESS[task_id]
 
     close_connection()
     if cancel:
@@ -198,7 +395,57 @@ async def collect():
     return redis_msg, task
 
 
-async def get_storage_binary(bucket, name):
+def _purge_storage_cache(incoming_size=0):
+    now = datetime.now().timestamp()
+    files = []
+    for f in os.listdir(STORAGE_CACHE_DIR):
+        path = os.path.join(STORAGE_CACHE_DIR, f)
+        try:
+            st = os.stat(path)
+            if now - st.st_mtime > STORAGE_CACHE_TTL:
+                os.remove(path)
+            else:
+                files.append((st.st_mtime, st.st_size, path))
+        except OSError:
+            pass
+    total = incoming_size + sum([size for _, size, _ in files])
+    for _, size, path in sorted(files):
+        if total <= STORAGE_CACHE_MAX_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def get_storage_binary_cached(bucket, name, cache_key):
+    path = os.path.join(STORAGE_CACHE_DIR, xxhash.xxh64(f"{cache_key}/{bucket}/{name}".encode("utf-8")).hexdigest())
+    try:
+        if datetime.now().timestamp() - os.path.getmtime(path) <= STORAGE_CACHE_TTL:
+            with open(path, "rb") as f:
+                return f.read()
+    except OSError:
+        pass
+
+    binary = STORAGE_IMPL.get(bucket, name)
+    if not binary or len(binary) > STORAGE_CACHE_MAX_MB * 1024 * 1024:
+        return binary
+    try:
+        os.makedirs(STORAGE_CACHE_DIR, exist_ok=True)
+        _purge_storage_cache(len(binary))
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(binary)
+        os.replace(tmp, path)
+    except OSError:
+        logging.exception("get_storage_binary_cached fails to write the cache")
+    return binary
+
+
+async def get_storage_binary(bucket, name, cache_key=None):
+    if cache_key and STORAGE_CACHE_DIR:
+        return await trio.to_thread.run_sync(lambda: get_storage_binary_cached(bucket, name, cache_key))
     return await trio.to_thread.run_sync(lambda: STORAGE_IMPL.get(bucket, name))
 
 
@@ -212,7 +459,8 @@ async def build_chunks(task, progress_callback):
     try:
         st = timer()
         bucket, name = File2DocumentService.get_storage_address(doc_id=task["doc_id"])
-        binary = await get_storage_binary(bucket, name)
+        # the tasks of a split PDF share the file through the local cache, keyed by document as locations are reused
+        binary = await get_storage_binary(bucket, name, task["doc_id"] if task["type"] == FileType.PDF.value else None)
         logging.info("From minio({}) {}/{}".format(timer() - st, task["location"], task["name"]))
     except TimeoutError:
         progress_callback(-1, "Internal server error: Fetch file from minio timeout. Could you try it again.")
@@ -229,7 +477,12 @@ async def build_chunks(task, progress_callback):
 
     try:
         async with chunk_limiter:
-            cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
+            if CHUNK_WORKER_POOL:
+                cks = await CHUNK_WORKER_POOL.chunk(chunker.__name__, dict(filename=task["name"], binary=binary, from_page=task["from_page"],
+                                to_page=task["to_page"], lang=task["language"],
+                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]), progress_callback)
+            else:
+                cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
                                 to_page=task["to_page"], lang=task["language"], callback=progress_callback,
                                 kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
         logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
@@ -248,7 +501,9 @@ async def build_chunks(task, progress_callback):
     if task["pagerank"]:
         doc[PAGERANK_FLD] = int(task["pagerank"])
     el = 0
-    for ck in cks:
+    for i in range(len(cks)):
+        # drop the reference held by the chunker output so the page image is released after uploading
+        ck, cks[i] = cks[i], None
         d = copy.deepcopy(doc)
         d.update(ck)
         d["id"] = xxhash.xxh64((ck["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
@@ -359,6 +614,11 @@ async def build_chunks(task, progress_callback):
                 nursery.start_soon(doc_content_tagging, chat_mdl, d, topn_tags)
         progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
 
+    def set_term_weights():
+        for d in docs:
+            d[TERM_WEIGHT_FLD] = settings.retrievaler.term_weight_field(d)
+    await trio.to_thread.run_sync(set_term_weights)
+
     return docs
 
 
@@ -367,13 +627,24 @@ def init_kb(row, vector_size: int):
     return settings.docStoreConn.createIdx(idxnm, row.get("kb_id", ""), vector_size)
 
 
-async def embedding(docs, mdl, parser_config=None, callback=None):
+def embedding_batch_size(mdl):
+    if EMBEDDING_BATCH_SIZE > 0:
+        return EMBEDDING_BATCH_SIZE
+    batch_size = getattr(mdl, "max_batch_size", 16)
+    max_batch_tokens = getattr(mdl, "max_batch_tokens", 0)
+    max_length = getattr(mdl, "max_length", 0)
+    if max_batch_tokens and max_length:
+        # every text may be as long as the model's max length
+        batch_size = min(batch_size, max(1, max_batch_tokens // max_length))
+    return batch_size
+
+
+async def embedding(docs, mdl, parser_config=None, callback=None, title_vts=None):
     if parser_config is None:
         parser_config = {}
-    batch_size = 16
-    tts, cnts = [], []
+    batch_size = embedding_batch_size(mdl)
+    cnts = []
     for d in docs:
-        tts.append(d.get("docnm_kwd", "Title"))
         c = "\n".join(d.get("question_kwd", []))
         if not c:
             c = d["content_with_weight"]
@@ -383,32 +654,30 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
         cnts.append(c)
 
     tk_count = 0
-    if len(tts) == len(cnts):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
-        tts = np.concatenate([vts for _ in range(len(tts))], axis=0)
+    if title_vts is None:
+        title_vts, c = await trio.to_thread.run_sync(lambda: mdl.encode([docs[0].get("docnm_kwd", "Title")]))
         tk_count += c
 
-    cnts_ = np.array([])
+    # Batch outputs are written in place into one float32 matrix instead of being concatenated.
+    vects = None
     for i in range(0, len(cnts), batch_size):
         vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(cnts[i: i + batch_size]))
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
+        if vects is None:
+            vects = np.empty((len(cnts), len(vts[0])), dtype=np.float32)
+        vects[i: i + len(vts)] = vts
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+        if callback:
+            callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
-    vects = (title_w * tts + (1 - title_w) *
-             cnts) if len(tts) == len(cnts) else cnts
+    vects *= (1 - title_w)
+    vects += title_w * np.asarray(title_vts[0], dtype=np.float32)
 
-    assert len(vects) == len(docs)
-    vector_size = 0
+    vector_size = vects.shape[1]
+    vctr_nm = "q_%d_vec" % vector_size
     for i, d in enumerate(docs):
-        v = vects[i].tolist()
-        vector_size = len(v)
-        d["q_%d_vec" % len(v)] = v
+        # Rows are contiguous float32 views, connectors serialize them without boxing every float.
+        d[vctr_nm] = vects[i] if DOC_STORE_NUMPY_VECTORS else vects[i].tolist()
     return tk_count, vector_size
 
 
@@ -428,7 +697,9 @@ async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
         row["parser_config"]["raptor"]["threshold"]
     )
     original_length = len(chunks)
-    chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback)
+    # a retry of the same task resumes from the layers already summarized
+    checkpoint_key = raptor_checkpoint_key(row["doc_id"], row["parser_config"]["raptor"], chunks)
+    chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback, checkpoint_key=checkpoint_key)
     doc = {
         "doc_id": row["doc_id"],
         "kb_id": [str(row["kb_id"])],
@@ -448,6 +719,7 @@ async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
         d["content_with_weight"] = content
         d["content_ltks"] = rag_tokenizer.tokenize(content)
         d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+        d[TERM_WEIGHT_FLD] = settings.retrievaler.term_weight_field(d)
         res.append(d)
         tk_count += num_tokens_from_string(content)
     return res, tk_count
@@ -471,6 +743,133 @@ async def run_graphrag(row, chat_model, language, embedding_model, callback=None
     await dealer()
 
 
+async def insert_chunks(task_id, task_tenant_id, task_dataset_id, windows, total, progress_callback, vector_field=None):
+    """
+    Index the chunk windows received from `windows` with several bulk requests in flight
+    and persist the inserted chunk ids in checkpoints. Vectors are released from the chunks
+    once indexed if `vector_field` is given. Returns False if the task disappeared meanwhile.
+    """
+    index_name = search.index_name(task_tenant_id)
+    errors = []
+    inserted_ids = []
+
+    async def insert_batch(batch, task_status=trio.TASK_STATUS_IGNORED):
+        async with doc_bulk_limiter:
+            task_status.started()
+            st = timer()
+            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(batch, index_name, task_dataset_id))
+            DOC_BULK_SIZER.record(len(batch), timer() - st, bool(doc_store_result))
+            if doc_store_result:
+                errors.append(doc_store_result)
+                return
+            inserted_ids.extend([chunk["id"] for chunk in batch])
+            if vector_field:
+                for chunk in batch:
+                    chunk.pop(vector_field, None)
+            progress_callback(prog=0.8 + 0.1 * len(inserted_ids) / total, msg="")
+
+    def persist_chunk_ids():
+        try:
+            TaskService.update_chunk_ids(task_id, " ".join(inserted_ids))
+        except DoesNotExist:
+            logging.warning(f"insert_chunks update_chunk_ids failed since task {task_id} is unknown.")
+            return False
+        return True
+
+    task_exists = True
+    checkpoint = CHUNK_IDS_CHECKPOINT
+    try:
+        async with windows, trio.open_nursery() as nursery:
+            async for window in windows:
+                for batch in DOC_BULK_SIZER.batches(window):
+                    if errors or not task_exists:
+                        break
+                    await nursery.start(insert_batch, batch)
+                    if len(inserted_ids) >= checkpoint:
+                        checkpoint = len(inserted_ids) + CHUNK_IDS_CHECKPOINT
+                        task_exists = await trio.to_thread.run_sync(persist_chunk_ids)
+                if errors or not task_exists:
+                    break
+    except BaseException:
+        # e.g. embedding failed or the task was canceled: the chunks indexed so far must still be
+        # recorded in the task, otherwise they are missed when the task is cleaned up
+        if task_exists and inserted_ids:
+            with trio.CancelScope(shield=True):
+                try:
+                    await trio.to_thread.run_sync(persist_chunk_ids)
+                except Exception:
+                    logging.exception(f"insert_chunks fail to keep the chunk ids of task {task_id}")
+        raise
+    logging.info("insert_chunks task {}, {}".format(task_id, DOC_BULK_SIZER.stats()))
+
+    if task_exists:
+        task_exists = await trio.to_thread.run_sync(persist_chunk_ids)
+    if not task_exists:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": inserted_ids}, index_name, task_dataset_id))
+        return False
+    if errors:
+        error_message = f"Insert chunk error: {errors[0]}, please check log file and Elasticsearch/Infinity status!"
+        progress_callback(-1, msg=error_message)
+        raise Exception(error_message)
+    return True
+
+
+async def embed_and_insert_chunks(task, chunks, embedding_model, vector_size, progress_callback):
+    """
+    Stream chunk windows through embedding and indexing over bounded channels,
+    so that model and doc store time overlap and only a few windows of vectors are alive at once.
+    Returns (token_count, indexed) where indexed is False if the task disappeared meanwhile.
+    """
+    send_embed, recv_embed = trio.open_memory_channel(PIPELINE_QUEUE_SIZE)
+    send_index, recv_index = trio.open_memory_channel(PIPELINE_QUEUE_SIZE)
+    st = timer()
+    stat = {"token_count": 0, "embedded": 0, "indexed": True}
+
+    async def produce():
+        async with send_embed:
+            for b in range(0, len(chunks), EMBEDDING_WINDOW_SIZE):
+                try:
+                    await send_embed.send(chunks[b:b + EMBEDDING_WINDOW_SIZE])
+                except trio.BrokenResourceError:
+                    # the embedding stage stopped early since the indexing stage did
+                    return
+
+    async def embed():
+        title_vts = None
+        async with recv_embed, send_index:
+            async for window in recv_embed:
+                if title_vts is None:
+                    title_vts, c = await trio.to_thread.run_sync(lambda: embedding_model.encode([window[0].get("docnm_kwd", "Title")]))
+                    stat["token_count"] += c
+                try:
+                    token_count, _ = await embedding(window, embedding_model, task["parser_config"], title_vts=title_vts)
+                except Exception as e:
+                    error_message = "Generate embedding error:{}".format(str(e))
+                    progress_callback(-1, error_message)
+                    logging.exception(error_message)
+                    raise
+                stat["token_count"] += token_count
+                stat["embedded"] += len(window)
+                progress_callback(prog=0.7 + 0.1 * stat["embedded"] / len(chunks),
+                                  msg="Embedded {}/{} chunks ({:.1f} chunks/s)".format(
+                                      stat["embedded"], len(chunks), stat["embedded"] / max(timer() - st, 1e-6)))
+                try:
+                    await send_index.send(window)
+                except trio.BrokenResourceError:
+                    # the indexing stage stopped early, e.g. the task is gone
+                    return
+
+    async def index():
+        stat["indexed"] = await insert_chunks(task["id"], task["tenant_id"], task["kb_id"], recv_index, len(chunks),
+                                              progress_callback, vector_field="q_%d_vec" % vector_size)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(produce)
+        nursery.start_soon(embed)
+        nursery.start_soon(index)
+    return stat["token_count"], stat["indexed"]
+
+
 async def do_handle_task(task):
     task_id = task["id"]
     task_from_page = task["from_page"]
@@ -482,7 +881,6 @@ async def do_handle_task(task):
     task_dataset_id = task["kb_id"]
     task_doc_id = task["doc_id"]
     task_document_name = task["name"]
-    task_parser_config = task["parser_config"]
     task_start_ts = timer()
 
     # prepare the progress callback function
@@ -519,6 +917,11 @@ async def do_handle_task(task):
         chat_model = LLMBundle(task_tenant_id, LLMType.CHAT, llm_name=task_llm_id, lang=task_language)
         # run RAPTOR
         chunks, token_count = await run_raptor(task, chat_model, embedding_model, vector_size, progress_callback)
+        start_ts = timer()
+        send_index, recv_index = trio.open_memory_channel(1)
+        send_index.send_nowait(chunks)
+        send_index.close()
+        indexed = await insert_chunks(task_id, task_tenant_id, task_dataset_id, recv_index, len(chunks), progress_callback)
     # Either using graphrag or Standard chunking methods
     elif task.get("task_type", "") == "graphrag":
         start_ts = timer()
@@ -560,38 +963,14 @@ async def do_handle_task(task):
         ## set_progress(task["did"], -1, "ERROR: ")
         progress_callback(msg="Generate {} chunks".format(len(chunks)))
         start_ts = timer()
-        try:
-            token_count, vector_size = await embedding(chunks, embedding_model, task_parser_config, progress_callback)
-        except Exception as e:
-            error_message = "Generate embedding error:{}".format(str(e))
-            progress_callback(-1, error_message)
-            logging.exception(error_message)
-            token_count = 0
-            raise
-        progress_message = "Embedding chunks ({:.2f}s)".format(timer() - start_ts)
+        token_count, indexed = await embed_and_insert_chunks(task, chunks, embedding_model, vector_size, progress_callback)
+        progress_message = "Embedding and indexing chunks ({:.2f}s)".format(timer() - start_ts)
         logging.info(progress_message)
         progress_callback(msg=progress_message)
 
+    if not indexed:
+        return
     chunk_count = len(set([chunk["id"] for chunk in chunks]))
-    start_ts = timer()
-    doc_store_result = ""
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(task_tenant_id), task_dataset_id))
-        if b % 128 == 0:
-            progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            progress_callback(-1, msg=error_message)
-            raise Exception(error_message)
-        chunk_ids = [chunk["id"] for chunk in chunks[:b + es_bulk_size]]
-        chunk_ids_str = " ".join(chunk_ids)
-        try:
-            TaskService.update_chunk_ids(task["id"], chunk_ids_str)
-        except DoesNotExist:
-            logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
-            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
-            return
     logging.info("Indexing doc({}), page({}-{}), chunks({}), elapsed: {:.2f}".format(task_document_name, task_from_page,
                                                                                      task_to_page, len(chunks),
                                                                                      timer() - start_ts))
@@ -612,6 +991,7 @@ async def handle_task():
     redis_msg, task = await collect()
     if not task:
         return
+    start_progress(task["id"])
     try:
         logging.info(f"handle_task begin for task {json.dumps(task)}")
         CURRENT_TASKS[task["id"]] = copy.deepcopy(task)
@@ -627,6 +1007,10 @@ async def handle_task():
         except Exception:
             pass
         logging.exception(f"handle_task got exception for task {json.dumps(task)}")
+    try:
+        flush_progress(task["id"])
+    except Exception:
+        logging.exception(f"flush_progress got exception for task {task['id']}")
     redis_msg.ack()
 
 
@@ -672,13 +1056,19 @@ async def main():
 /_/  \__,_/____/_/|_|  /_____/_/|_|\___/\___/\__,_/\__/\____/_/                               
     """)
     logging.info(f'TaskExecutor: RAGFlow version: {get_ragflow_version()}')
-    settings.init_settings()
+    with log_startup_time("settings"):
+        settings.init_settings()
     print_rag_settings()
     signal.signal(signal.SIGUSR1, start_tracemalloc_and_snapshot)
     signal.signal(signal.SIGUSR2, stop_tracemalloc)
+    signal.signal(signal.SIGTERM, flush_usage_and_terminate)
     TRACE_MALLOC_ENABLED = int(os.environ.get('TRACE_MALLOC_ENABLED', "0"))
     if TRACE_MALLOC_ENABLED:
         start_tracemalloc_and_snapshot(None, None)
+    global CHUNK_WORKER_POOL
+    if CHUNK_WORKER_PROCESSES > 0:
+        logging.info(f"Start {CHUNK_WORKER_PROCESSES} chunk worker processes")
+        CHUNK_WORKER_POOL = ChunkWorkerPool(CHUNK_WORKER_PROCESSES, CHUNK_WORKER_MAX_RSS_MB)
 
     async with trio.open_nursery() as nursery:
         nursery.start_soon(report_status)
@@ -201,10 +201,12 @@ class DocStoreConnection(ABC):
             indexNames: str|list[str],
             knowledgebaseIds: list[str],
             aggFields: list[str] = [],
-            rank_feature: dict | None = None
+            rank_feature: dict | None = None,
+            track_total_hits: bool = True
     ):
         """
-        Search with given conjunctive equivalent filtering condition and return all fields of matched documents
+        Search with given conjunctive equivalent filtering condition and return `selectFields` of matched documents.
+        Callers that don't need an exact total set `track_total_hits` to False, getTotal is then a lower bound.
         """
         raise NotImplementedError("Not implemented")
 
@@ -229,6 +231,13 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    @abstractmethod
+    def updateBulk(self, rows: list[dict], indexName: str, knowledgebaseId: str) -> list[str]:
+        """
+        Set the given fields of many rows, each row is keyed by its "id". Returns the errors, empty if all succeeded.
+        """
+        raise NotImplementedError("Not implemented")
+
     @abstractmethod
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         """
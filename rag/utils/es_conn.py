@@ -33,6 +33,8 @@ from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr,
 from rag.nlp import is_english, rag_tokenizer
 
 ATTEMPT_TIME = 2
+# Number of partial updates per bulk request of updateBulk
+UPDATE_BULK_SIZE = int(os.environ.get("UPDATE_BULK_SIZE", "1024"))
 
 logger = logging.getLogger('ragflow.es_conn')
 
@@ -140,10 +142,12 @@ class ESConnection(DocStoreConnection):
             indexNames: str | list[str],
             knowledgebaseIds: list[str],
             aggFields: list[str] = [],
-            rank_feature: dict | None = None
+            rank_feature: dict | None = None,
+            track_total_hits: bool = True
     ):
         """
         Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl.html
+        Only `selectFields` are fetched from _source, none if it's empty.
         """
         if isinstance(indexNames, str):
             indexNames = indexNames.split(",")
@@ -243,8 +247,8 @@ class ESConnection(DocStoreConnection):
                                      body=q,
                                      timeout="600s",
                                      # search_type="dfs_query_then_fetch",
-                                     track_total_hits=True,
-                                     _source=True)
+                                     track_total_hits=track_total_hits,
+                                     _source=selectFields if selectFields else False)
                 if str(res.get("timed_out", "")).lower() == "true":
                     raise Exception("Es Timeout.")
                 logger.debug(f"ESConnection.search {str(indexNames)} res: " + str(res))
@@ -396,6 +400,38 @@ class ESConnection(DocStoreConnection):
                 break
         return False
 
+    def updateBulk(self, rows: list[dict], indexName: str, knowledgebaseId: str) -> list[str]:
+        # Partial updates through the bulk API, the index is refreshed once after the last request.
+        res = []
+        for b in range(0, len(rows), UPDATE_BULK_SIZE):
+            operations = []
+            for d in rows[b:b + UPDATE_BULK_SIZE]:
+                doc = copy.deepcopy(d)
+                meta_id = doc.pop("id")
+                operations.append({"update": {"_index": indexName, "_id": meta_id}})
+                operations.append({"doc": doc})
+            for i in range(ATTEMPT_TIME):
+                try:
+                    r = self.es.bulk(index=indexName, operations=operations, refresh=False, timeout="60s")
+                    if r["errors"]:
+                        for item in r["items"]:
+                            if "error" in item["update"]:
+                                res.append(str(item["update"]["_id"]) + ":" + str(item["update"]["error"]))
+                    break
+                except Exception as e:
+                    logger.warning("ESConnection.updateBulk got exception: " + str(e))
+                    if re.search(r"(Timeout|time out|connection)", str(e), re.IGNORECASE) and i < ATTEMPT_TIME - 1:
+                        time.sleep(3)
+                        continue
+                    res.append(str(e))
+                    break
+        if rows:
+            try:
+                self.es.indices.refresh(index=indexName)
+            except Exception as e:
+                logger.warning("ESConnection.updateBulk refresh got exception: " + str(e))
+        return res
+
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
@@ -445,6 +481,9 @@ class ESConnection(DocStoreConnection):
     """
 
     def getTotal(self, res):
+        if "total" not in res["hits"]:
+            # searched without track_total_hits
+            return len(res["hits"]["hits"])
         if isinstance(res["hits"]["total"], type({})):
             return res["hits"]["total"]["value"]
         return res["hits"]["total"]
@@ -455,6 +494,7 @@ class ESConnection(DocStoreConnection):
     def __getSource(self, res):
         rr = []
         for d in res["hits"]["hits"]:
+            d.setdefault("_source", {})
             d["_source"]["id"] = d["_id"]
             d["_source"]["_score"] = d["_score"]
             rr.append(d["_source"])
@@ -467,7 +507,7 @@ class ESConnection(DocStoreConnection):
         for d in self.__getSource(res):
             m = {n: d.get(n) for n in fields if d.get(n) is not None}
             for n, v in m.items():
-                if isinstance(v, list):
+                if isinstance(v, (list, dict)):
                     m[n] = v
                     continue
                 if not isinstance(v, str):
@@ -490,7 +530,10 @@ class ESConnection(DocStoreConnection):
                 ans[d["_id"]] = txt
                 continue
 
-            txt = d["_source"][fieldnm]
+            txt = d.get("_source", {}).get(fieldnm)
+            if not txt:
+                ans[d["_id"]] = "...".join([a for a in list(hlts.items())[0][1]])
+                continue
             txt = re.sub(r"[\r\n]", " ", txt, flags=re.IGNORECASE | re.MULTILINE)
             txts = []
             for t in re.split(r"[.?!;\n]", txt):
@@ -20,6 +20,7 @@ import re
 import json
 import time
 import copy
+import numpy as np
 import infinity
 from infinity.common import ConflictType, InfinityException, SortType
 from infinity.index import IndexInfo, IndexType
@@ -280,7 +281,8 @@ class InfinityConnection(DocStoreConnection):
             indexNames: str | list[str],
             knowledgebaseIds: list[str],
             aggFields: list[str] = [],
-            rank_feature: dict | None = None
+            rank_feature: dict | None = None,
+            track_total_hits: bool = True
     ) -> list[dict] | pl.DataFrame:
         """
         TODO: Infinity doesn't provide highlight
@@ -494,6 +496,8 @@ class InfinityConnection(DocStoreConnection):
                 elif k in ["page_num_int", "top_int"]:
                     assert isinstance(v, list)
                     d[k] = "_".join(f"{num:08x}" for num in v)
+                elif isinstance(v, np.ndarray):
+                    d[k] = v.tolist()
 
             for n, vs in embedding_clmns:
                 if n in d:
@@ -523,6 +527,34 @@ class InfinityConnection(DocStoreConnection):
         #if "exists" in condition:
         #    del condition["exists"]
         filter = equivalent_condition_to_str(condition, table_instance)
+        self._convert_new_value(newValue)
+
+        logger.debug(f"INFINITY update table {table_name}, filter {filter}, newValue {newValue}.")
+        table_instance.update(filter, newValue)
+        self.connPool.release_conn(inf_conn)
+        return True
+
+    def updateBulk(self, rows: list[dict], indexName: str, knowledgebaseId: str) -> list[str]:
+        # Infinity has no multi-row update with distinct values, rows are updated by id on one table handle.
+        inf_conn = self.connPool.get_conn()
+        db_instance = inf_conn.get_database(self.dbName)
+        table_name = f"{indexName}_{knowledgebaseId}"
+        table_instance = db_instance.get_table(table_name)
+        res = []
+        for d in rows:
+            newValue = copy.deepcopy(d)
+            chunk_id = newValue.pop("id")
+            self._convert_new_value(newValue)
+            try:
+                table_instance.update(f"id = '{chunk_id}'", newValue)
+            except Exception as e:
+                res.append(f"{chunk_id}:{e}")
+        logger.debug(f"INFINITY updated {len(rows) - len(res)} rows of table {table_name}.")
+        self.connPool.release_conn(inf_conn)
+        return res
+
+    @staticmethod
+    def _convert_new_value(newValue: dict):
         for k, v in list(newValue.items()):
             if k in ["important_kwd", "question_kwd", "entities_kwd", "tag_kwd", "source_id"]:
                 assert isinstance(v, list)
@@ -546,11 +578,6 @@ class InfinityConnection(DocStoreConnection):
                 if v in [PAGERANK_FLD]:
                     newValue[v] = 0
 
-        logger.debug(f"INFINITY update table {table_name}, filter {filter}, newValue {newValue}.")
-        table_instance.update(filter, newValue)
-        self.connPool.release_conn(inf_conn)
-        return True
-
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         inf_conn = self.connPool.get_conn()
         db_instance = inf_conn.get_database(self.dbName)
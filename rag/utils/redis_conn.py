@@ -51,6 +51,8 @@ class RedisMsg:
 class RedisDB:
     def __init__(self):
         self.REDIS = None
+        # same server, values are returned as raw bytes
+        self.REDIS_BIN = None
         self.config = settings.REDIS
         self.__open__()
 
@@ -63,6 +65,13 @@ class RedisDB:
                 password=self.config.get("password"),
                 decode_responses=True,
             )
+            self.REDIS_BIN = redis.StrictRedis(
+                host=self.config["host"].split(":")[0],
+                port=int(self.config.get("host", ":6379").split(":")[1]),
+                db=int(self.config.get("db", 1)),
+                password=self.config.get("password"),
+                decode_responses=False,
+            )
         except Exception:
             logging.warning("Redis can't be connected.")
         return self.REDIS
@@ -114,6 +123,38 @@ class RedisDB:
             self.__open__()
         return False
 
+    def delete(self, k):
+        try:
+            return self.REDIS.delete(k)
+        except Exception as e:
+            logging.warning("RedisDB.delete " + str(k) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def mget_bin(self, keys: list):
+        if not self.REDIS_BIN or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS_BIN.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget_bin got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset_bin(self, mapping: dict, exp=3600):
+        if not self.REDIS_BIN or not mapping:
+            return False
+        try:
+            pipe = self.REDIS_BIN.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipe.set(k, v, exp)
+            pipe.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset_bin got exception: " + str(e))
+            self.__open__()
+        return False
+
     def sadd(self, key: str, member: str):
         try:
             self.REDIS.sadd(key, member)
@@ -143,6 +184,14 @@ class RedisDB:
             self.__open__()
         return None
 
+    def spop(self, key: str, count: int):
+        try:
+            return self.REDIS.spop(key, count) or []
+        except Exception as e:
+            logging.warning("RedisDB.spop " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return []
+
     def zadd(self, key: str, member: str, score: float):
         try:
             self.REDIS.zadd(key, {member: score})
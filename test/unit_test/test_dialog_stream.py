@@ -0,0 +1,69 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from types import SimpleNamespace
+
+import pytest
+
+dialog_service = pytest.importorskip("api.db.services.dialog_service")
+
+ANSWER = "The quick brown fox jumps over the lazy dog. " * 4 + "Done."
+
+
+class FakeChatModel:
+    def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese"):
+        pass
+
+    def chat_streamly(self, system, history, gen_conf):
+        # the answer so far, growing a few characters at a time
+        for i in range(7, len(ANSWER), 7):
+            yield ANSWER[:i]
+        yield ANSWER
+
+
+@pytest.fixture
+def dialog(monkeypatch):
+    monkeypatch.setattr(dialog_service, "LLMBundle", FakeChatModel)
+    monkeypatch.setattr(dialog_service, "llm_id2llm_type", lambda llm_id: "chat")
+    return SimpleNamespace(tenant_id="tenant", llm_id="fake", kb_ids=[], prompt_config={"system": ""}, llm_setting={})
+
+
+def chat(dialog, **kwargs):
+    return list(dialog_service.chat(dialog, [{"role": "user", "content": "hi"}], True, **kwargs))
+
+
+def test_full_answers_without_delta(dialog):
+    events = chat(dialog)
+    assert all("delta" not in e for e in events)
+    assert all(ANSWER.startswith(e["answer"]) for e in events)
+    # the tail shorter than CHAT_STREAM_MIN_DELTA_CHARS is not dropped
+    assert events[-1]["answer"] == ANSWER
+
+
+def test_deltas_add_up_to_the_answer(dialog):
+    events = chat(dialog, delta=True)
+    deltas = [e for e in events[:-1] if e.get("delta")]
+    assert len(deltas) == len(events) - 1
+    assert "".join(e["answer"] for e in deltas) == ANSWER
+    assert all(len(e["answer"]) >= dialog_service.CHAT_STREAM_MIN_DELTA_CHARS for e in deltas[:-1])
+    # the closing event carries the whole answer for the callers keeping the conversation
+    assert "delta" not in events[-1]
+    assert events[-1]["answer"] == ANSWER
+
+
+def test_stream_event():
+    assert dialog_service.stream_event("abcdef", "def", False, None)["answer"] == "abcdef"
+    ev = dialog_service.stream_event("abcdef", "def", True, None)
+    assert ev["answer"] == "def" and ev["delta"]
@@ -0,0 +1,37 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+np = pytest.importorskip("numpy")
+eb = pytest.importorskip("rag.llm.embedding_batcher")
+
+
+class ShortModel:
+    """Returns one vector less than it was given texts."""
+
+    def encode(self, texts):
+        return np.ones((max(0, len(texts) - 1), 4)), len(texts)
+
+
+def test_missing_vectors_fail_the_whole_batch():
+    batcher = eb.EmbeddingBatcher(ShortModel(), max_batch_size=8, max_wait=0.05)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(batcher.encode, tenant_id, ["a", "b"]) for tenant_id in ("t1", "t2")]
+        for f in futures:
+            with pytest.raises(Exception, match=r"returned \d+ vectors for \d+ texts"):
+                f.result(timeout=5)
@@ -0,0 +1,47 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import itertools
+
+import pytest
+
+pytest.importorskip("editdistance")
+er = pytest.importorskip("graphrag.entity_resolution")
+
+
+@pytest.fixture
+def resolution():
+    # _candidate_pairs needs neither the LLM nor the graph store
+    return object.__new__(er.EntityResolution)
+
+
+def test_short_names_without_common_bigram_are_paired(resolution):
+    pairs = resolution._candidate_pairs(sorted(["cat", "cut", "dog"]))
+    assert ("cat", "cut") in pairs
+
+
+def test_short_english_names_lose_no_similar_pair(resolution):
+    names = sorted(["cat", "cut", "cot", "coat", "bat", "abcd", "axcx", "apple", "ample", "banana", "bandana",
+                    "xylophone", "saxophone", "north sea", "north see"])
+    pairs = set(resolution._candidate_pairs(names))
+    for a, b in itertools.combinations(names, 2):
+        if min(len(a), len(b)) < er.ENTITY_RESOLUTION_MIN_BLOCK_LEN and resolution.is_similarity(a, b):
+            assert (a, b) in pairs
+
+
+def test_long_names_still_blocked(resolution):
+    # no bigram in common, so these are never compared
+    pairs = resolution._candidate_pairs(sorted(["abcdefghij", "klmnopqrst"]))
+    assert pairs == []
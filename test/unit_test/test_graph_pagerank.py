@@ -0,0 +1,88 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from types import SimpleNamespace
+
+import pytest
+
+nx = pytest.importorskip("networkx")
+gu = pytest.importorskip("graphrag.utils")
+
+
+class FakeDocStore:
+    def __init__(self):
+        self.rank_updates = []
+        self.fail = False
+
+    def updateBulk(self, rows, index_name, kb_id):
+        if self.fail:
+            return ["bulk failed"]
+        self.rank_updates.append({r["id"]: r["rank_flt"] for r in rows if "rank_flt" in r})
+        return []
+
+    def update(self, condition, new_value, index_name, kb_id):
+        return True
+
+    def insert(self, rows, index_name, kb_id):
+        return []
+
+
+@pytest.fixture
+def doc_store(monkeypatch):
+    store = FakeDocStore()
+    monkeypatch.setattr(gu.settings, "docStoreConn", store)
+    monkeypatch.setattr(gu.settings, "retrievaler", SimpleNamespace(search=lambda *args, **kwargs: SimpleNamespace(ids=[])))
+    monkeypatch.setattr(gu, "get_entity_chunk_ids", lambda tenant_id, kb_id, names: {n: [f"chunk_{n}"] for n in names})
+    return store
+
+
+def graph_with_ranks(ranks):
+    graph = nx.Graph()
+    graph.add_edge("a", "b", weight=1)
+    graph.add_edge("b", "c", weight=1)
+    for n, p in ranks.items():
+        graph.nodes[n]["pagerank"] = p
+        graph.nodes[n]["entity_type"] = "T"
+    return graph
+
+
+def test_small_moves_add_up_to_a_write(monkeypatch, doc_store):
+    ranks = {"a": 0.3, "b": 0.4, "c": 0.3}
+    graph = graph_with_ranks(ranks)
+    # "a" moves by 0.6% of its stored rank on each merge, under GRAPH_PAGERANK_RTOL alone
+    step = 0.006 * ranks["a"]
+    for i in range(1, 4):
+        monkeypatch.setattr(gu.nx, "pagerank", lambda g, i=i: {**ranks, "a": ranks["a"] + i * step})
+        gu.update_nodes_pagerank_nhop_neighbour("tenant", "kb", graph, 2, dirty_nodes=set())
+
+    written = [u for u in doc_store.rank_updates if u]
+    # the second merge moved "a" by 1.2% from the rank written last, the third only by 0.6% from there
+    assert written == [{"chunk_a": pytest.approx(ranks["a"] + 2 * step)}]
+    assert graph.nodes["a"]["pagerank"] == pytest.approx(ranks["a"] + 2 * step)
+    assert graph.nodes["b"]["pagerank"] == ranks["b"]
+
+
+def test_rank_kept_when_the_write_fails(monkeypatch, doc_store):
+    ranks = {"a": 0.3, "b": 0.4, "c": 0.3}
+    graph = graph_with_ranks(ranks)
+    monkeypatch.setattr(gu.nx, "pagerank", lambda g: {**ranks, "a": 0.6})
+    doc_store.fail = True
+    gu.update_nodes_pagerank_nhop_neighbour("tenant", "kb", graph, 2, dirty_nodes=set())
+    assert graph.nodes["a"]["pagerank"] == 0.3
+
+    doc_store.fail = False
+    gu.update_nodes_pagerank_nhop_neighbour("tenant", "kb", graph, 2, dirty_nodes=set())
+    assert doc_store.rank_updates[-1] == {"chunk_a": 0.6}
+    assert graph.nodes["a"]["pagerank"] == 0.6
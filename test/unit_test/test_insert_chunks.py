@@ -0,0 +1,140 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import sys
+from types import SimpleNamespace
+
+import pytest
+import trio
+
+if sys.version_info < (3, 11):
+    from exceptiongroup import ExceptionGroup
+
+te = pytest.importorskip("rag.svr.task_executor")
+
+
+class FakeDocStore:
+    def __init__(self):
+        self.inserted = []
+        self.deleted = []
+
+    def insert(self, batch, index_name, kb_id):
+        self.inserted.extend([c["id"] for c in batch])
+        return []
+
+    def delete(self, condition, index_name, kb_id):
+        self.deleted.extend(condition["id"])
+
+
+@pytest.fixture
+def doc_store(monkeypatch):
+    store = FakeDocStore()
+    monkeypatch.setattr(te.settings, "docStoreConn", store)
+    return store
+
+
+@pytest.fixture
+def saved_chunk_ids(monkeypatch):
+    saved = {}
+
+    def update_chunk_ids(task_id, chunk_ids):
+        saved[task_id] = chunk_ids.split()
+
+    monkeypatch.setattr(te.TaskService, "update_chunk_ids", update_chunk_ids)
+    return saved
+
+
+def chunk_windows(n_windows, window_size):
+    send, recv = trio.open_memory_channel(n_windows)
+    for w in range(n_windows):
+        send.send_nowait([{"id": f"c{w}_{i}", "content_with_weight": "x"} for i in range(window_size)])
+    send.close()
+    return recv
+
+
+def assert_raised_alone(excinfo, exc_type, message):
+    errors = excinfo.value.exceptions
+    assert len(errors) == 1
+    assert isinstance(errors[0], exc_type)
+    assert str(errors[0]) == message
+
+
+def test_chunk_ids_saved_at_the_end(doc_store, saved_chunk_ids):
+    windows = chunk_windows(3, 5)
+    ok = trio.run(te.insert_chunks, "t1", "tenant", "kb", windows, 15, lambda prog=None, msg="": None)
+    assert ok
+    assert sorted(saved_chunk_ids["t1"]) == sorted(doc_store.inserted)
+    assert len(doc_store.inserted) == 15
+
+
+def test_chunk_ids_saved_when_canceled(doc_store, saved_chunk_ids):
+    calls = []
+
+    def progress_callback(prog=None, msg=""):
+        calls.append(prog)
+        if len(calls) == 2:
+            raise te.TaskCanceledException("canceled")
+
+    windows = chunk_windows(4, 5)
+    # raised from a bulk task of the nursery
+    with pytest.raises(ExceptionGroup) as excinfo:
+        trio.run(te.insert_chunks, "t2", "tenant", "kb", windows, 20, progress_callback, strict_exception_groups=True)
+    assert_raised_alone(excinfo, te.TaskCanceledException, "canceled")
+    # every chunk that reached the doc store is recorded in the task, so cleaning the task up removes it
+    assert doc_store.inserted
+    assert sorted(saved_chunk_ids["t2"]) == sorted(doc_store.inserted)
+
+
+def test_chunk_ids_saved_when_upstream_fails(doc_store, saved_chunk_ids):
+    async def run():
+        send, recv = trio.open_memory_channel(1)
+
+        async def produce():
+            async with send:
+                await send.send([{"id": f"c{i}", "content_with_weight": "x"} for i in range(5)])
+                await trio.sleep(0.1)
+                raise RuntimeError("embedding failed")
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(produce)
+            nursery.start_soon(te.insert_chunks, "t3", "tenant", "kb", recv, 10, lambda prog=None, msg="": None)
+
+    with pytest.raises(ExceptionGroup) as excinfo:
+        trio.run(run, strict_exception_groups=True)
+    assert_raised_alone(excinfo, RuntimeError, "embedding failed")
+    assert len(doc_store.inserted) == 5
+    assert sorted(saved_chunk_ids["t3"]) == sorted(doc_store.inserted)
+
+
+def test_pipeline_stops_when_the_task_is_gone(monkeypatch, doc_store):
+    def update_chunk_ids(task_id, chunk_ids):
+        raise te.DoesNotExist()
+
+    async def embedding(docs, mdl, parser_config=None, callback=None, title_vts=None):
+        return len(docs), None
+
+    monkeypatch.setattr(te.TaskService, "update_chunk_ids", update_chunk_ids)
+    monkeypatch.setattr(te, "embedding", embedding)
+    monkeypatch.setattr(te, "CHUNK_IDS_CHECKPOINT", 1)
+    monkeypatch.setattr(te, "EMBEDDING_WINDOW_SIZE", 2)
+    monkeypatch.setattr(te, "PIPELINE_QUEUE_SIZE", 1)
+    model = SimpleNamespace(encode=lambda texts: (None, 1))
+    task = {"id": "t4", "tenant_id": "tenant", "kb_id": "kb", "parser_config": {}}
+    # many more windows than the channels hold are still to be embedded when indexing stops
+    chunks = [{"id": f"c{i}", "content_with_weight": "x"} for i in range(40)]
+    _, indexed = trio.run(te.embed_and_insert_chunks, task, chunks, model, 8, lambda prog=None, msg="": None)
+    assert not indexed
+    assert doc_store.inserted
+    assert sorted(doc_store.deleted) == sorted(doc_store.inserted)
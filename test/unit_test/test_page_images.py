@@ -0,0 +1,47 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+pdf_parser = pytest.importorskip("deepdoc.parser.pdf_parser")
+
+
+def _pages(n):
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 255, (60, 40, 3), dtype=np.uint8)) for _ in range(n)]
+
+
+def test_keeps_only_the_window_decoded():
+    images = pdf_parser.PageImages(2)
+    for img in _pages(5):
+        images.append(img)
+    assert len(images) == 5
+    assert list(images.decoded.keys()) == [3, 4]
+    images[0]
+    assert list(images.decoded.keys()) == [4, 0]
+
+
+def test_pages_are_lossless():
+    pages = _pages(4)
+    images = pdf_parser.PageImages(1)
+    for img in pages:
+        images.append(img)
+    for got, want in zip(images, pages):
+        assert got.size == want.size and got.mode == want.mode
+        assert (np.array(got) == np.array(want)).all()
+    assert (np.array(images[-4].crop((5, 5, 20, 30))) == np.array(pages[0].crop((5, 5, 20, 30)))).all()
+    assert [img.size for img in images[1:3]] == [pages[1].size, pages[2].size]
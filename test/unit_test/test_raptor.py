@@ -0,0 +1,115 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+
+import pytest
+import trio
+
+np = pytest.importorskip("numpy")
+raptor = pytest.importorskip("rag.raptor")
+
+CONFIG = {"max_cluster": 64, "prompt": "{cluster_content}", "max_token": 256, "threshold": 0.1, "random_seed": 0}
+
+
+class FakeRedis:
+    def __init__(self):
+        self.kv = {}
+
+    def get(self, k):
+        return self.kv.get(k)
+
+    def set(self, k, v, exp=3600):
+        self.kv[k] = v
+        return True
+
+    def delete(self, k):
+        self.kv.pop(k, None)
+        return True
+
+
+class FakeChat:
+    llm_name = "fake-chat"
+    max_length = 8192
+
+    def __init__(self):
+        self.calls = 0
+
+    def chat(self, system, history, gen_conf):
+        self.calls += 1
+        return "summary {}".format(self.calls)
+
+
+class FakeEmbedding:
+    max_batch_size = 16
+
+    def encode(self, texts):
+        return np.ones((len(texts), 4)), len(texts)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(raptor, "REDIS_CONN", r)
+    monkeypatch.setattr(raptor, "get_llm_cache", lambda *args: None)
+    monkeypatch.setattr(raptor, "set_llm_cache", lambda *args: None)
+    return r
+
+
+def chunks_of(texts):
+    return [(t, np.ones(4)) for t in texts]
+
+
+def test_checkpoint_key_depends_on_the_chunks():
+    key = raptor.raptor_checkpoint_key("doc", CONFIG, chunks_of(["a", "b", "c"]))
+    assert key == raptor.raptor_checkpoint_key("doc", CONFIG, chunks_of(["a", "b", "c"]))
+    # a re-parse with as many chunks but different ones must not resume the old summaries
+    assert key != raptor.raptor_checkpoint_key("doc", CONFIG, chunks_of(["a", "b", "d"]))
+    assert key != raptor.raptor_checkpoint_key("doc", {**CONFIG, "max_token": 512}, chunks_of(["a", "b", "c"]))
+    assert key != raptor.raptor_checkpoint_key("other", CONFIG, chunks_of(["a", "b", "c"]))
+
+
+def test_resume_after_the_layers_checkpointed(redis):
+    chunks = chunks_of(["a", "b", "c", "d"])
+    key = raptor.raptor_checkpoint_key("doc", CONFIG, chunks)
+    # the first layer summarized the 4 chunks into 2 before the task failed
+    redis.set(key, json.dumps({
+        "n_chunks": 4,
+        "summaries": [("ab", [1.0] * 4), ("cd", [1.0] * 4)],
+        "layers": [(0, 4), (4, 6)],
+        "labels": [0, 0, 1, 1],
+        "start": 4,
+        "end": 6,
+    }))
+    chat = FakeChat()
+    rp = raptor.RecursiveAbstractiveProcessing4TreeOrganizedRetrieval(64, chat, FakeEmbedding(), CONFIG["prompt"], 256, 0.1)
+    res = trio.run(lambda: rp(chunks, 0, checkpoint_key=key))
+
+    # only the last layer is summarized again
+    assert chat.calls == 1
+    assert [cnt for cnt, _ in res] == ["a", "b", "c", "d", "ab", "cd", "summary 1"]
+    assert key not in redis.kv
+
+
+def test_stale_checkpoint_is_not_resumed(redis):
+    old_key = raptor.raptor_checkpoint_key("doc", CONFIG, chunks_of(["a", "b"]))
+    redis.set(old_key, json.dumps({"n_chunks": 2, "summaries": [("stale", [1.0] * 4)], "layers": [(0, 2), (2, 3)],
+                                   "labels": [0, 0], "start": 2, "end": 3}))
+    chunks = chunks_of(["x", "y"])
+    chat = FakeChat()
+    rp = raptor.RecursiveAbstractiveProcessing4TreeOrganizedRetrieval(64, chat, FakeEmbedding(), CONFIG["prompt"], 256, 0.1)
+    res = trio.run(lambda: rp(chunks, 0, checkpoint_key=raptor.raptor_checkpoint_key("doc", CONFIG, chunks)))
+    assert chat.calls == 1
+    assert [cnt for cnt, _ in res] == ["x", "y", "summary 1"]
@@ -0,0 +1,54 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+pytest.importorskip("networkx")
+gu = pytest.importorskip("graphrag.utils")
+
+
+class PagedDocStore:
+    """Pages of graph rows, counting like a search made with track_total_hits=False."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def search(self, fields, highlight, condition, match_exprs, order_by, offset, limit, index_names, kb_ids,
+               track_total_hits=True):
+        return self.rows[offset:offset + limit]
+
+    def getTotal(self, res):
+        return len(res)
+
+    def getFields(self, res, fields):
+        return {r["id"]: r for r in res}
+
+
+def entity_rows(n):
+    return [{"id": f"e{i}", "entity_kwd": f"ent{i}", "entity_type_kwd": "T", "knowledge_graph_kwd": "entity",
+             "source_id": [f"doc{i % 7}"]} for i in range(n)]
+
+
+@pytest.mark.parametrize("n", [256, 300, 512])
+def test_rebuild_keeps_every_page(monkeypatch, n):
+    monkeypatch.setattr(gu.settings, "docStoreConn", PagedDocStore(entity_rows(n)))
+    graph, src_ids = gu.rebuild_graph("tenant", "kb")
+    assert graph.number_of_nodes() == n
+    assert sorted(src_ids) == sorted({f"doc{i % 7}" for i in range(n)})
+
+
+def test_rebuild_of_an_empty_graph(monkeypatch):
+    monkeypatch.setattr(gu.settings, "docStoreConn", PagedDocStore([]))
+    assert gu.rebuild_graph("tenant", "kb") == (None, None)
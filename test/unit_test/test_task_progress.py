@@ -0,0 +1,122 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+te = pytest.importorskip("rag.svr.task_executor")
+
+
+class FakeTaskRow:
+    def __init__(self):
+        self.progress = 0.0
+        self.msgs = []
+        self.writes = 0
+
+    def append_progress(self, task_id, progress_msg, progress=None):
+        # slow enough for concurrent flushes to overlap if nothing serializes them
+        msgs = list(self.msgs)
+        time.sleep(0.001)
+        if progress_msg:
+            msgs.extend(progress_msg.split("\n"))
+        self.msgs = msgs
+        if progress is not None:
+            self.progress = progress
+        self.writes += 1
+
+
+@pytest.fixture
+def row(monkeypatch):
+    r = FakeTaskRow()
+    monkeypatch.setattr(te.TaskService, "append_progress", r.append_progress)
+    monkeypatch.setattr(te.TaskService, "get_by_id", lambda task_id: (True, SimpleNamespace(doc_id="doc")))
+    monkeypatch.setattr(te.TaskService, "has_cancel_flag", lambda doc_id: False)
+    monkeypatch.setattr(te.TaskService, "do_cancel", lambda task_id: False)
+    monkeypatch.setattr(te.DocumentService, "publish_progress_event", lambda doc_id: None)
+    monkeypatch.setattr(te, "close_connection", lambda: None)
+    monkeypatch.setattr(te, "PROGRESS_FLUSH_INTERVAL", 3600)
+    yield r
+    te.TASK_PROGRESS.clear()
+    te.ENDED_TASK_PROGRESS.clear()
+
+
+def test_messages_are_coalesced(row):
+    for i in range(10):
+        te.set_progress("t1", prog=0.1 + i * 0.01, msg=f"step {i}")
+    assert row.writes == 0
+    te.set_progress("t1", prog=1.0, msg="done")
+    # everything buffered goes out in one write with the final progress
+    assert row.writes == 1
+    assert [m.split(" ", 1)[1] for m in row.msgs] == [f"step {i}" for i in range(10)] + ["done"]
+    assert row.progress == 1.0
+
+
+def test_progress_never_goes_back_after_the_end(row):
+    te.set_progress("t2", prog=1.0, msg="done")
+    te.set_progress("t2", prog=0.5, msg="late")
+    te.flush_progress("t2")
+    assert row.progress == 1.0
+
+    te.set_progress("t3", prog=-1, msg="failed")
+    te.set_progress("t3", prog=0.8, msg="late")
+    te.flush_progress("t3")
+    assert row.progress == -1
+
+
+def test_concurrent_flushes_lose_no_message(row, monkeypatch):
+    monkeypatch.setattr(te, "PROGRESS_FLUSH_INTERVAL", 0)
+
+    def report(n):
+        for i in range(50):
+            te.set_progress("t4", prog=0.5, msg=f"thread {n} step {i}")
+
+    threads = [threading.Thread(target=report, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    te.flush_progress("t4")
+
+    msgs = [m.split(" ", 1)[1] for m in row.msgs]
+    assert len(msgs) == 200
+    for n in range(4):
+        assert [m for m in msgs if m.startswith(f"thread {n} ")] == [f"thread {n} step {i}" for i in range(50)]
+
+
+def test_late_updates_after_the_task_is_over(row):
+    te.set_progress("t5", prog=1.0, msg="done")
+    te.flush_progress("t5")
+    writes = row.writes
+
+    # a chunker thread of the task still reporting
+    te.set_progress("t5", prog=0.6, msg="late")
+    assert row.writes == writes + 1
+    assert row.msgs[-1].split(" ", 1)[1] == "late"
+    assert row.progress == 1.0
+    assert "t5" not in te.TASK_PROGRESS
+
+
+def test_progress_of_a_task_handled_again(row):
+    te.set_progress("t6", prog=-1, msg="failed")
+    te.flush_progress("t6")
+
+    te.start_progress("t6")
+    te.set_progress("t6", prog=0.3, msg="retry")
+    assert "t6" in te.TASK_PROGRESS
+    te.set_progress("t6", prog=1.0, msg="done")
+    assert row.progress == 1.0